@@ -1,27 +1,172 @@
 import os
 import json
 import base64
+import contextlib
+import functools
+import hmac
+import hashlib
+import heapq
 import time
+import atexit
 import logging
+import logging.handlers
+import math
+import mmap
+import queue
+import random
+import shutil
 import sqlite3
-from flask import Flask, request, jsonify, make_response
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:     # not on Windows; startup then runs without the file lock
+    fcntl = None
+from flask import Flask, Response, request, make_response
+from flask import jsonify as _flask_jsonify
 
 # ---------------- LOGGING ----------------
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("server.log", encoding="utf-8")
-    ]
-)
+# records go onto an in-memory queue and a background listener does the console
+# and file I/O, so a request never waits on disk under the logging lock
+LOG_FILE = "server.log"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+LOG_QUEUE_SIZE = 10000
+# fraction of requests that get a structured access record; errors (5xx) and
+# slow requests are always recorded
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", "0.05"))
+ACCESS_LOG_SLOW_MS = float(os.environ.get("ACCESS_LOG_SLOW_MS", "500"))
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops (and counts) records instead of blocking when the
+    queue is full, and runs its own listener in whichever process it is used
+    in: gunicorn forks after import and threads don't survive the fork.
+    """
+
+    def __init__(self, handlers, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.target_handlers = handlers
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # fresh queue too: the inherited one may have been locked mid-fork
+            self.queue = queue.Queue(self.maxsize)
+            self._listener = logging.handlers.QueueListener(self.queue, *self.target_handlers,
+                                                            respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        # drain what is queued (called at exit)
+        if self._listener is not None and self._pid == os.getpid():
+            try:
+                self._listener.stop()
+            except queue.Full:
+                pass
+
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that several processes (gunicorn workers) share: the
+    size check, rollover and write happen under a file lock, and a process whose
+    open file was rotated away by another one reopens the new file first.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lock_file = self.baseFilename + ".lock"
+        self._lock_fd = None
+        self._lock_pid = None
+
+    def _lock(self):
+        # per process: a descriptor inherited across fork would share its lock
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+
+    def _follow_rotation(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.path.samestat(os.stat(self.baseFilename), os.fstat(self.stream.fileno()))
+        except OSError:
+            current = False
+        if not current:
+            self.stream.close()
+            self.stream = None      # reopened on the next write
+
+    def emit(self, record):
+        if fcntl is None:
+            return super().emit(record)
+        try:
+            self._lock()
+        except OSError:
+            self.handleError(record)
+            return
+        try:
+            self._follow_rotation()
+            super().emit(record)
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+
+_log_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_stream_handler = logging.StreamHandler()
+_file_handler = SharedRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES,
+                                          backupCount=LOG_BACKUP_COUNT,
+                                          encoding="utf-8", delay=True)
+for _h in (_stream_handler, _file_handler):
+    _h.setFormatter(_log_format)
+log_handler = NonBlockingQueueHandler([_stream_handler, _file_handler], LOG_QUEUE_SIZE)
+log_handler.setFormatter(logging.Formatter("%(message)s"))   # only merges args; targets add the prefix
+logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.DEBUG), handlers=[log_handler])
+atexit.register(log_handler.stop)
+access_log = logging.getLogger("access")
 
 app = Flask(__name__)
 
+
+def jsonify(*args, **kwargs):
+    # flask.jsonify, with its time charged to the request's "serialize" stage
+    t0 = time.perf_counter()
+    try:
+        return _flask_jsonify(*args, **kwargs)
+    finally:
+        _charge_stage("serialize", t0)
+
 # --- filenames (keep keys_db.json for compatibility with original clients) ---
 DB_JSON_FILE = "keys_db.json"   # returned by endpoints exactly as before
 DB_SQLITE_FILE = "keys.db"      # internal authoritative store to avoid corruption
 
+# seconds to coalesce verification writes before the JSON snapshot is rewritten
+# (0 = rewrite synchronously after every verification, the old behaviour)
+SNAPSHOT_DEBOUNCE_SECONDS = float(os.environ.get("SNAPSHOT_DEBOUNCE_SECONDS", "2.0"))
+
 # ---------------- DEFAULT DB (used only if DB file missing/corrupt) ----------------
 DEFAULT_DB = {
     "SECURE_KEYS": {
@@ -55,11 +200,157 @@ PASS_DELETE = "HJSPCH"
 PASS_ADD = "JDJDODO"
 PASS_DOWNLOAD = "JDKDXPCHE"
 PASS_UPLOAD = "DJJDJSDPS"
+PASS_METRICS = "MTRKSPDX"
+PASS_LIST = "Xksps"
+
+
+# ---------------- SQLite connection layer ----------------
+# one long-lived connection per process/thread instead of connect+close per request.
+# WAL lets readers run while another worker commits; synchronous=NORMAL is durable
+# across application crashes in WAL mode and skips the per-commit fsync of FULL.
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "10"))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_STATEMENT_CACHE = 256
+
+# hot-path statements; sqlite3 caches prepared statements by SQL text, so these
+# constants are compiled once per connection and reused on every request
+SQL_SELECT_SECURE = "SELECT is_used,device_id FROM secure_keys WHERE package=? AND key_value=?"
+SQL_SELECT_SIMPLE = "SELECT is_used,device_id FROM simple_keys WHERE key_value=?"
+# compare-and-set: binds a free key or refreshes the holder's binding in one statement
+SQL_BIND_SECURE = ("UPDATE secure_keys SET is_used=1,device_id=?,last_verified=? "
+                   "WHERE package=? AND key_value=? AND (is_used=0 OR device_id=?)")
+SQL_BIND_SIMPLE = ("UPDATE simple_keys SET is_used=1,device_id=?,last_verified=? "
+                   "WHERE key_value=? AND (is_used=0 OR device_id=?)")
+
+_db_local = threading.local()
+_stage_timer = threading.local()  # seconds the current request spent per stage (sqlite, signature, ...)
+
+
+def _charge_stage(stage, t0):
+    d = _stage_timer.__dict__
+    d[stage] = d.get(stage, 0.0) + (time.perf_counter() - t0)
+
+
+def note_outcome(outcome):
+    # verification outcome(s) of the current request, counted by the metrics hook
+    _stage_timer.__dict__.setdefault("outcomes", []).append(outcome)
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that charges execute/commit time to the current request's stages."""
+
+    def execute(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            _charge_stage("sqlite_query", t0)
+
+    def executemany(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            _charge_stage("sqlite_query", t0)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _charge_stage("sqlite_commit", t0)
+
+
+# ---------------- SHARDING (optional) ----------------
+# SQLITE_SHARDS > 1 spreads the keys over that many sqlite files, each with the
+# full schema (its own change counter and change_log), so writers to different
+# shards never wait on one another. secure_keys are routed by package and
+# simple_keys by key. Changing the shard count starts from empty shard files,
+# which startup then fills from keys_db.json.
+SQLITE_SHARDS = max(1, int(os.environ.get("SQLITE_SHARDS", "1")))
+
+
+def shard_file(shard):
+    if SQLITE_SHARDS == 1:
+        return DB_SQLITE_FILE
+    root, ext = os.path.splitext(DB_SQLITE_FILE)
+    return f"{root}.shard{shard}-of-{SQLITE_SHARDS}{ext}"
+
+
+def shard_for(package, key):
+    """Shard holding (package, key); package=None means simple_keys."""
+    if SQLITE_SHARDS == 1:
+        return 0
+    route = package if package else key
+    return zlib.crc32(route.encode("utf-8", "surrogatepass")) % SQLITE_SHARDS
+
+
+def _open_sqlite(shard=0):
+    con = sqlite3.connect(shard_file(shard), timeout=SQLITE_BUSY_TIMEOUT,
+                          cached_statements=SQLITE_STATEMENT_CACHE, factory=TimedConnection)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    con.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+
+def get_db(shard=0):
+    """Return this thread's connection to a shard, opening it on first use."""
+    cons = getattr(_db_local, "cons", None)
+    # connections inherited across fork (gunicorn workers) must never be used
+    if cons is None or _db_local.pid != os.getpid():
+        cons = _db_local.cons = [None] * SQLITE_SHARDS
+        _db_local.pid = os.getpid()
+    con = cons[shard]
+    if con is None:
+        con = cons[shard] = _open_sqlite(shard)
+    return con
+
+
+def all_dbs():
+    """This thread's connections to every shard, in shard order."""
+    return [get_db(i) for i in range(SQLITE_SHARDS)]
+
+
+def open_db_snapshot():
+    """Dedicated connections, one read transaction per shard; the caller closes them."""
+    cons = []
+    try:
+        for i in range(SQLITE_SHARDS):
+            cons.append(_open_sqlite(i))
+            cons[-1].execute("BEGIN")
+    except Exception:
+        for con in cons:
+            con.close()
+        raise
+    return cons
+
+
+def _open_dbs():
+    # this thread's already-open connections (never opens new ones)
+    cons = getattr(_db_local, "cons", None)
+    if cons is None or _db_local.pid != os.getpid():
+        return []
+    return [con for con in cons if con is not None]
+
+
+def close_db():
+    """Close this thread's connections (used before gunicorn forks workers)."""
+    for con in _open_dbs():
+        con.close()
+    _db_local.cons = None
 
 
 # ---------------- SQLite helpers (authoritative store) ----------------
 def init_sqlite():
-    con = sqlite3.connect(DB_SQLITE_FILE)
+    for con in all_dbs():
+        _init_schema(con)
+
+
+def _init_schema(con):
     cur = con.cursor()
     cur.execute("""
         CREATE TABLE IF NOT EXISTS secure_keys (
@@ -79,105 +370,835 @@ def init_sqlite():
             last_verified REAL
         )
     """)
+    # change counter bumped by triggers on every row change, from any worker;
+    # drives the ETag of /download_db and /list_all
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS db_meta (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    cur.execute("INSERT OR IGNORE INTO db_meta(name,value) VALUES('change_counter',0)")
+    # append-only change log for delta sync; seq is monotonic (AUTOINCREMENT never
+    # reuses a value, even after compaction). changelog_floor = last compacted seq
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            op TEXT NOT NULL,
+            package TEXT,
+            key_value TEXT,
+            is_used INTEGER,
+            device_id TEXT
+        )
+    """)
+    cur.execute("INSERT OR IGNORE INTO db_meta(name,value) VALUES('changelog_floor',0)")
+    # partial secondary indexes: only bound rows carry a device or a verification
+    # time, so free keys cost nothing here. They serve the device lookup
+    # (device_id=? implies NOT NULL) and the stale-binding sweep (is_used=1 AND last_verified<?)
+    for table in ("secure_keys", "simple_keys"):
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_device ON {table}(device_id) WHERE device_id IS NOT NULL")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_verified ON {table}(last_verified) WHERE is_used=1")
+    # used/free listing and the per-package summary walk these in key order
+    cur.execute("CREATE INDEX IF NOT EXISTS secure_keys_used ON secure_keys(is_used,package,key_value)")
+    cur.execute("CREATE INDEX IF NOT EXISTS simple_keys_used ON simple_keys(is_used,key_value)")
+    create_change_triggers(cur)
     con.commit()
-    con.close()
+
+
+# unix time inside a trigger
+_SQL_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+def create_change_triggers(cur):
+    for table in ("secure_keys", "simple_keys"):
+        pkg = "{row}.package" if table == "secure_keys" else "NULL"
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            row = "OLD" if op == "DELETE" else "NEW"
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_counter AFTER {op} ON {table}
+                BEGIN
+                    UPDATE db_meta SET value=value+1 WHERE name='change_counter';
+                END
+            """)
+            # log inserts, deletes and binding changes; last_verified-only
+            # refreshes (heartbeats) are not changes worth replicating
+            when = ("WHEN OLD.is_used IS NOT NEW.is_used OR OLD.device_id IS NOT NEW.device_id"
+                    if op == "UPDATE" else "")
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_log AFTER {op} ON {table} {when}
+                BEGIN
+                    INSERT INTO change_log(ts,op,package,key_value,is_used,device_id)
+                    VALUES({_SQL_NOW},'{op.lower()}',{pkg.format(row=row)},{row}.key_value,{row}.is_used,{row}.device_id);
+                END
+            """)
+
+
+def drop_change_triggers(cur):
+    # bulk swaps drop the per-row triggers and bump the counter / log a reset once instead
+    for table in ("secure_keys", "simple_keys"):
+        for op in ("insert", "update", "delete"):
+            cur.execute(f"DROP TRIGGER IF EXISTS {table}_{op}_counter")
+            cur.execute(f"DROP TRIGGER IF EXISTS {table}_{op}_log")
+
+
+def get_change_counter(con):
+    row = con.execute("SELECT value FROM db_meta WHERE name='change_counter'").fetchone()
+    return row[0] if row else 0
+
+
+def total_change_counter(cons):
+    # every shard's counter only grows, so their sum does too
+    return sum(get_change_counter(con) for con in cons)
+
+
+def get_last_change_seq(con):
+    # sqlite_sequence keeps the high-water mark even when the log is compacted empty
+    row = con.execute("SELECT seq FROM sqlite_sequence WHERE name='change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def format_change_cursor(seqs):
+    # change_log position across shards: the plain seq with one shard (as before),
+    # "seq0.seq1..." (one seq per shard's own log) when sharded
+    return seqs[0] if SQLITE_SHARDS == 1 else ".".join(str(s) for s in seqs)
+
+
+def parse_change_cursor(value):
+    """Per-shard seqs from a change cursor; ValueError if it doesn't fit the shard count."""
+    parts = [int(p) for p in str(value).split(".")]
+    if len(parts) == 1 and SQLITE_SHARDS > 1 and parts[0] == 0:
+        return [0] * SQLITE_SHARDS      # "from the beginning" needs no shard layout
+    if len(parts) != SQLITE_SHARDS:
+        raise ValueError(f"cursor must have {SQLITE_SHARDS} part(s)")
+    return parts
 
 
 def sql_load_from_json_if_needed():
     """
     If sqlite DB empty and keys_db.json exists, load it.
     If neither exists, create both from DEFAULT_DB.
-    Always ensure JSON snapshot exists.
+    Always ensure JSON snapshot exists (rewritten only when it is stale).
     """
     init_sqlite()
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
 
-    # check whether DB has data
-    cur.execute("SELECT COUNT(*) FROM simple_keys")
-    simple_count = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM secure_keys")
-    secure_count = cur.fetchone()[0]
+    # check whether DB has data (existence only, so this doesn't scale with DB size)
+    has_rows = any(con.execute("SELECT 1 FROM simple_keys LIMIT 1").fetchone() is not None
+                   or con.execute("SELECT 1 FROM secure_keys LIMIT 1").fetchone() is not None
+                   for con in all_dbs())
 
-    if (simple_count == 0 and secure_count == 0) and os.path.exists(DB_JSON_FILE):
-        # try to load JSON into sqlite
+    if not has_rows and os.path.exists(DB_JSON_FILE):
+        # try to load JSON into sqlite (same streaming path as /upload_db)
         try:
-            with open(DB_JSON_FILE, "r") as f:
-                j = json.load(f)
-            # load simple
-            for k, v in j.get("SIMPLE_KEYS", {}).items():
-                cur.execute("INSERT OR REPLACE INTO simple_keys(key_value,is_used,device_id,last_verified) VALUES(?,?,?,?)",
-                            (k, int(v.get("is_used", False)), v.get("device_id"), v.get("last_verified")))
-            # load secure
-            for pkg, keys in j.get("SECURE_KEYS", {}).items():
-                for k, v in keys.items():
-                    cur.execute("INSERT OR REPLACE INTO secure_keys(package,key_value,is_used,device_id,last_verified) VALUES(?,?,?,?,?)",
-                                (pkg, k, int(v.get("is_used", False)), v.get("device_id"), v.get("last_verified")))
-            con.commit()
+            restore_from_json_upload(DB_JSON_FILE)
         except Exception:
             # fallback to defaults
             write_json_snapshot(DEFAULT_DB)
             load_defaults_into_sqlite(DEFAULT_DB)
-    elif (simple_count == 0 and secure_count == 0) and not os.path.exists(DB_JSON_FILE):
+    elif not has_rows and not os.path.exists(DB_JSON_FILE):
         # create both from defaults
         write_json_snapshot(DEFAULT_DB)
         load_defaults_into_sqlite(DEFAULT_DB)
 
-    con.close()
     # ensure json snapshot exists and in sync
-    write_json_snapshot(sqlite_to_json())
+    if not snapshot_is_current():
+        update_snapshot_from_sqlite()
 
 
 def load_defaults_into_sqlite(dbobj):
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
     for k, v in dbobj.get("SIMPLE_KEYS", {}).items():
-        cur.execute("INSERT OR REPLACE INTO simple_keys(key_value,is_used,device_id,last_verified) VALUES(?,?,?,?)",
-                    (k, int(v.get("is_used", False)), v.get("device_id"), v.get("last_verified")))
+        get_db(shard_for(None, k)).execute(
+            "INSERT OR REPLACE INTO simple_keys(key_value,is_used,device_id,last_verified) VALUES(?,?,?,?)",
+            (k, int(v.get("is_used", False)), v.get("device_id"), v.get("last_verified")))
     for pkg, keys in dbobj.get("SECURE_KEYS", {}).items():
+        con = get_db(shard_for(pkg, None))
         for k, v in keys.items():
-            cur.execute("INSERT OR REPLACE INTO secure_keys(package,key_value,is_used,device_id,last_verified) VALUES(?,?,?,?,?)",
+            con.execute("INSERT OR REPLACE INTO secure_keys(package,key_value,is_used,device_id,last_verified) VALUES(?,?,?,?,?)",
                         (pkg, k, int(v.get("is_used", False)), v.get("device_id"), v.get("last_verified")))
-    con.commit()
-    con.close()
+    for con in all_dbs():
+        con.commit()
 
 
 def sqlite_to_json():
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
     out = {"SECURE_KEYS": {}, "SIMPLE_KEYS": {}}
-    cur.execute("SELECT key_value,is_used,device_id,last_verified FROM simple_keys")
-    for row in cur.fetchall():
-        k, is_used, device_id, last_verified = row
-        out["SIMPLE_KEYS"][k] = {"is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
-    cur.execute("SELECT package,key_value,is_used,device_id,last_verified FROM secure_keys")
-    for row in cur.fetchall():
-        pkg, k, is_used, device_id, last_verified = row
-        if pkg not in out["SECURE_KEYS"]:
-            out["SECURE_KEYS"][pkg] = {}
-        out["SECURE_KEYS"][pkg][k] = {"is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
-    con.close()
+    for con in all_dbs():
+        cur = con.cursor()
+        cur.execute("SELECT key_value,is_used,device_id,last_verified FROM simple_keys")
+        for row in cur.fetchall():
+            k, is_used, device_id, last_verified = row
+            out["SIMPLE_KEYS"][k] = {"is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
+        cur.execute("SELECT package,key_value,is_used,device_id,last_verified FROM secure_keys")
+        for row in cur.fetchall():
+            pkg, k, is_used, device_id, last_verified = row
+            if pkg not in out["SECURE_KEYS"]:
+                out["SECURE_KEYS"][pkg] = {}
+            out["SECURE_KEYS"][pkg][k] = {"is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
     return out
 
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def merged_rows(cons, sql, key, params=()):
+    """Rows of the same ORDER BY query on every shard, merged into one ordered stream."""
+    if len(cons) == 1:
+        return cons[0].execute(sql, params)
+    return heapq.merge(*(con.execute(sql, params) for con in cons), key=key)
+
+
+def iter_db_json(cons, indent=4, sort_keys=False):
+    """
+    Yield the SECURE_KEYS/SIMPLE_KEYS document in chunks, straight from sqlite
+    cursors ordered by package/key (merged across shards), without building
+    the nested dict. indent=4 matches json.dump(indent=4); indent=None matches
+    compact jsonify.
+    """
+    sep = ": " if indent else ":"
+
+    def nl(level):
+        return "\n" + " " * (indent * level) if indent else ""
+
+    def entry(is_used, device_id, last_verified, level):
+        e = {"is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
+        text = json.dumps(e, indent=indent, sort_keys=sort_keys,
+                          separators=None if indent else (",", ":"))
+        return text.replace("\n", nl(level)) if indent else text
+
+    buf = []
+    size = 0
+
+    def emit(part):
+        nonlocal size
+        buf.append(part)
+        size += len(part)
+
+    emit("{" + nl(1) + '"SECURE_KEYS"' + sep + "{")
+    current_pkg = None
+    first_pkg = True
+    first_key = True
+    for pkg, k, is_used, device_id, last_verified in merged_rows(
+            cons, "SELECT package,key_value,is_used,device_id,last_verified FROM secure_keys ORDER BY package,key_value",
+            key=lambda r: (r[0], r[1])):
+        if pkg != current_pkg:
+            if current_pkg is not None:
+                emit(nl(2) + "}")
+            emit(("" if first_pkg else ",") + nl(2) + json.dumps(pkg) + sep + "{")
+            current_pkg = pkg
+            first_pkg = False
+            first_key = True
+        emit(("" if first_key else ",") + nl(3) + json.dumps(k) + sep + entry(is_used, device_id, last_verified, 3))
+        first_key = False
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buf)
+            buf.clear()
+            size = 0
+    if current_pkg is not None:
+        emit(nl(2) + "}" + nl(1) + "}")
+    else:
+        emit("}")
+
+    emit("," + nl(1) + '"SIMPLE_KEYS"' + sep + "{")
+    first_key = True
+    for k, is_used, device_id, last_verified in merged_rows(
+            cons, "SELECT key_value,is_used,device_id,last_verified FROM simple_keys ORDER BY key_value",
+            key=lambda r: r[0]):
+        emit(("" if first_key else ",") + nl(2) + json.dumps(k) + sep + entry(is_used, device_id, last_verified, 2))
+        first_key = False
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buf)
+            buf.clear()
+            size = 0
+    emit(("}" if first_key else nl(1) + "}") + nl(0) + "}")
+    yield "".join(buf)
+
+
+# read once at import: os.umask() can only be queried by setting it, which
+# isn't safe once other threads create files
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def _snapshot_mode():
+    # mkstemp creates 0600 files; keys_db.json keeps the mode it had, or gets
+    # what a plain open() would give it (0644 under umask 022)
+    try:
+        return stat.S_IMODE(os.stat(DB_JSON_FILE).st_mode)
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+def _replace_snapshot(write):
+    # dump to a temp file next to the snapshot and rename it over the old one,
+    # so a download never sees a half-written file
+    target_dir = os.path.dirname(os.path.abspath(DB_JSON_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix=".keys_db.", suffix=".tmp", dir=target_dir)
+    try:
+        os.fchmod(fd, _snapshot_mode())
+        with os.fdopen(fd, "w") as f:
+            write(f)
+        os.replace(tmp_path, DB_JSON_FILE)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def write_json_snapshot(data_obj):
-    # write to JSON exactly as the original code expected
+    # write to JSON exactly as the original code expected, but atomically
     try:
-        with open(DB_JSON_FILE, "w") as f:
-            json.dump(data_obj, f, indent=4)
+        _replace_snapshot(lambda f: json.dump(data_obj, f, indent=4))
         return True
     except Exception as e:
         logging.exception("Failed to write JSON snapshot: %s", e)
         return False
 
 
+def write_json_snapshot_from_sqlite():
+    # streamed from one read snapshot (per shard), so the change counter recorded
+    # with the file matches (or predates) exactly what was written
+    try:
+        cons = open_db_snapshot()
+    except Exception as e:
+        logging.exception("Failed to write JSON snapshot: %s", e)
+        return False
+    try:
+        counter = total_change_counter(cons)
+
+        def write(f):
+            for chunk in iter_db_json(cons, indent=4):
+                f.write(chunk)
+
+        _replace_snapshot(write)
+    except Exception as e:
+        logging.exception("Failed to write JSON snapshot: %s", e)
+        return False
+    finally:
+        for con in cons:
+            con.close()
+    record_snapshot(counter)
+    return True
+
+
+def record_snapshot(counter):
+    # remember which DB state keys_db.json holds, so startup can skip the rewrite
+    # (kept in shard 0; counter is the total over all shards)
+    try:
+        mtime_ns = os.stat(DB_JSON_FILE).st_mtime_ns
+
+        def write():
+            con = get_db(0)
+            con.executemany("INSERT OR REPLACE INTO db_meta(name,value) VALUES(?,?)",
+                            [("snapshot_counter", counter), ("snapshot_mtime_ns", mtime_ns)])
+            con.commit()
+
+        run_write(write)
+    except Exception:
+        logging.exception("Failed to record snapshot state")
+
+
+def snapshot_is_current():
+    try:
+        mtime_ns = os.stat(DB_JSON_FILE).st_mtime_ns
+    except OSError:
+        return False
+    con = get_db(0)
+    meta = dict(con.execute("SELECT name,value FROM db_meta WHERE name IN ('snapshot_counter','snapshot_mtime_ns')"))
+    return (meta.get("snapshot_mtime_ns") == mtime_ns
+            and meta.get("snapshot_counter") == total_change_counter(all_dbs()))
+
+
+# ---------------- JSON snapshot writer (write-behind) ----------------
+_snapshot_lock = threading.Lock()       # one full rewrite at a time
+# ... across gunicorn workers too; the waiting one then finds the file current
+SNAPSHOT_LOCK_FILE = DB_SQLITE_FILE + ".snapshot.lock"
+_snapshot_dirty = threading.Event()     # sqlite changed since the last rewrite
+_snapshot_thread = None
+_snapshot_thread_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _snapshot_file_lock():
+    with open(SNAPSHOT_LOCK_FILE, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
 def update_snapshot_from_sqlite():
-    j = sqlite_to_json()
-    write_json_snapshot(j)
+    # synchronous full rewrite; also satisfies any pending write-behind request.
+    # the dirty flag is cleared before reading so a commit racing with the dump
+    # marks it dirty again and is picked up by the next pass. Buffered heartbeats
+    # go first (outside the lock: their flush marks the snapshot dirty itself)
+    t0 = time.perf_counter()
+    flush_heartbeats()
+    with _snapshot_lock, _snapshot_file_lock():
+        _snapshot_dirty.clear()
+        # skipped when keys_db.json already holds this exact DB state, e.g.
+        # another worker wrote it, or the changes were all reverted
+        ok = snapshot_is_current() or write_json_snapshot_from_sqlite()
+    _charge_stage("snapshot_write", t0)
+    return ok
+
+
+def flush_snapshot():
+    """Rewrite keys_db.json now if any change is still pending."""
+    if _snapshot_dirty.is_set():
+        update_snapshot_from_sqlite()
+
+
+def _snapshot_writer_loop():
+    while True:
+        _snapshot_dirty.wait()
+        # debounce: let a burst of verifications collapse into one rewrite
+        time.sleep(SNAPSHOT_DEBOUNCE_SECONDS)
+        try:
+            flush_snapshot()
+        except Exception:
+            logging.exception("Background snapshot write failed")
 
 
-# Initialize on startup (preserve original JSON logic)
-sql_load_from_json_if_needed()
+def _ensure_snapshot_writer():
+    global _snapshot_thread
+    # started lazily so every gunicorn worker gets its own thread after fork
+    if _snapshot_thread is not None and _snapshot_thread.is_alive():
+        return
+    with _snapshot_thread_lock:
+        if _snapshot_thread is None or not _snapshot_thread.is_alive():
+            _snapshot_thread = threading.Thread(target=_snapshot_writer_loop,
+                                                name="snapshot-writer", daemon=True)
+            _snapshot_thread.start()
+
+
+def mark_snapshot_dirty():
+    """Schedule a background rewrite of keys_db.json after a sqlite change."""
+    if SNAPSHOT_DEBOUNCE_SECONDS <= 0:
+        update_snapshot_from_sqlite()
+        return
+    _snapshot_dirty.set()
+    _ensure_snapshot_writer()
+
+
+# flush whatever is still pending when the process (or gunicorn worker) exits
+atexit.register(flush_snapshot)
+
+
+# ---------------- STREAMING RESTORE (upload_db) ----------------
+RESTORE_BATCH_SIZE = 5000
+DB_STAGING_FILE = DB_SQLITE_FILE + ".staging"
+
+
+class JsonStreamReader:
+    """
+    Minimal pull parser for the keys_db.json shape. The object levels are
+    walked by hand and each leaf value is decoded with raw_decode, so only
+    one chunk of the upload is held in memory at a time.
+    """
+
+    def __init__(self, f, chunk_size=STREAM_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError(f"expected {ch!r} at offset {self.pos}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a bare number may continue in the next chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+    def iter_object(self):
+        # yields each member name; the caller must consume the member's value
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            name = self.value()
+            if not isinstance(name, str):
+                raise ValueError("object member name must be a string")
+            self.expect(":")
+            yield name
+            ch = self.peek()
+            if ch == ",":
+                self.pos += 1
+            elif ch == "}":
+                self.pos += 1
+                return
+            else:
+                raise ValueError(f"expected ',' or '}}' at offset {self.pos}")
+
+    def end(self):
+        if self.peek() != "":
+            raise ValueError("trailing data after JSON document")
+
+
+def _entry_row(v):
+    if not isinstance(v, dict):
+        raise ValueError("key entry must be an object")
+    device_id, last_verified = v.get("device_id"), v.get("last_verified")
+    if not isinstance(device_id, (str, type(None))):
+        raise ValueError("device_id must be a string or null")
+    if isinstance(last_verified, bool) or not isinstance(last_verified, (int, float, type(None))):
+        raise ValueError("last_verified must be a number or null")
+    return int(v.get("is_used", False)), device_id, last_verified
+
+
+def _create_staging_tables(con):
+    # each row is tagged with its shard up front, so the swap is one indexed range per shard
+    con.execute("CREATE TABLE staging.simple_keys "
+                "(shard INTEGER, key_value TEXT, is_used INTEGER, device_id TEXT, last_verified REAL)")
+    con.execute("CREATE TABLE staging.secure_keys "
+                "(shard INTEGER, package TEXT, key_value TEXT, is_used INTEGER, device_id TEXT, last_verified REAL)")
+
+
+def _index_staging_tables(con):
+    # index after the load; the swap then reads the staging rows in key order
+    con.execute("CREATE INDEX staging.simple_keys_idx ON simple_keys(shard,key_value)")
+    con.execute("CREATE INDEX staging.secure_keys_idx ON secure_keys(shard,package,key_value)")
+
+
+def stage_json_upload(con, f):
+    """
+    Parse an uploaded keys_db.json incrementally into the attached staging
+    tables. Raises ValueError for anything malformed; live tables are untouched.
+    """
+    _create_staging_tables(con)
+    simple_sql = "INSERT INTO staging.simple_keys VALUES(?,?,?,?,?)"
+    secure_sql = "INSERT INTO staging.secure_keys VALUES(?,?,?,?,?,?)"
+    simple, secure = [], []
+    counts = {"SIMPLE_KEYS": 0, "SECURE_KEYS": 0}
+    reader = JsonStreamReader(f)
+    try:
+        for section in reader.iter_object():
+            if section == "SIMPLE_KEYS":
+                for k in reader.iter_object():
+                    simple.append((shard_for(None, k), k) + _entry_row(reader.value()))
+                    if len(simple) >= RESTORE_BATCH_SIZE:
+                        con.executemany(simple_sql, simple)
+                        counts[section] += len(simple)
+                        simple.clear()
+            elif section == "SECURE_KEYS":
+                for pkg in reader.iter_object():
+                    shard = shard_for(pkg, None)
+                    for k in reader.iter_object():
+                        secure.append((shard, pkg, k) + _entry_row(reader.value()))
+                        if len(secure) >= RESTORE_BATCH_SIZE:
+                            con.executemany(secure_sql, secure)
+                            counts[section] += len(secure)
+                            secure.clear()
+            else:
+                reader.value()      # ignored, as before
+        reader.end()
+        con.executemany(simple_sql, simple)
+        con.executemany(secure_sql, secure)
+        counts["SIMPLE_KEYS"] += len(simple)
+        counts["SECURE_KEYS"] += len(secure)
+        con.commit()
+    except (ValueError, TypeError, UnicodeDecodeError, sqlite3.InterfaceError) as e:
+        raise ValueError(str(e)) from e
+    _index_staging_tables(con)
+    return counts
+
+
+def swap_in_staging(cons):
+    # one write transaction per shard: readers (WAL) see the old tables until COMMIT
+    # and the complete new ones after it, never an empty table in between. Every
+    # shard's write lock is taken (in shard order) before the first commit.
+    # (not BEGIN IMMEDIATE: that would also lock the shared, attached staging file;
+    # the first statement is a write to main, so main's lock is taken right away)
+    try:
+        for shard, con in enumerate(cons):
+            con.execute("BEGIN")
+            con.execute("UPDATE main.db_meta SET value=value+1 WHERE name='change_counter'")
+            drop_change_triggers(con)
+            con.execute("DELETE FROM main.simple_keys")
+            con.execute("DELETE FROM main.secure_keys")
+            # ORDER BY rowid within a key keeps "last one wins" for duplicates, like json.load
+            con.execute("INSERT OR REPLACE INTO main.simple_keys(key_value,is_used,device_id,last_verified) "
+                        "SELECT key_value,is_used,device_id,last_verified FROM staging.simple_keys "
+                        "WHERE shard=? ORDER BY key_value,rowid", (shard,))
+            con.execute("INSERT OR REPLACE INTO main.secure_keys(package,key_value,is_used,device_id,last_verified) "
+                        "SELECT package,key_value,is_used,device_id,last_verified FROM staging.secure_keys "
+                        "WHERE shard=? ORDER BY package,key_value,rowid", (shard,))
+            create_change_triggers(con)
+            # delta consumers must re-download everything after a restore
+            con.execute(f"INSERT INTO change_log(ts,op) VALUES({_SQL_NOW},'reset')")
+        for con in cons:
+            con.commit()
+    except Exception:
+        for con in cons:
+            if con.in_transaction:
+                con.rollback()
+        raise
+
+
+def restore_from_json_upload(path):
+    """Stage the uploaded file at path and atomically swap it in. ValueError = malformed upload."""
+    def stage(con):
+        with open(path, "r", encoding="utf-8-sig") as f:
+            return stage_json_upload(con, f)
+    return restore_via_staging(stage)
+
+
+@contextlib.contextmanager
+def _staging_attached(cons):
+    attached = []
+    try:
+        for con in cons:
+            con.execute("ATTACH DATABASE ? AS staging", (DB_STAGING_FILE,))
+            attached.append(con)
+        yield
+    finally:
+        for con in attached:
+            if con.in_transaction:
+                con.rollback()
+            con.execute("DETACH DATABASE staging")
+
+
+def restore_via_staging(stage):
+    """Fill the staging tables with stage(con), then swap them in on every shard."""
+    if os.path.exists(DB_STAGING_FILE):
+        os.remove(DB_STAGING_FILE)
+
+    def swap():
+        cons = all_dbs()
+        with _staging_attached(cons):
+            swap_in_staging(cons)
+
+    try:
+        # staging only writes the scratch file, so it runs here; the swap is the
+        # live write and goes where writes belong (run_write)
+        con = get_db(0)
+        with _staging_attached([con]):
+            # scratch data: no journal, no fsync
+            con.execute("PRAGMA staging.journal_mode=OFF")
+            con.execute("PRAGMA staging.synchronous=OFF")
+            counts = stage(con)
+        flush_heartbeats()
+        run_write(swap)
+        return counts
+    finally:
+        try:
+            os.remove(DB_STAGING_FILE)
+        except OSError:
+            pass
+
+
+# ---------------- BINARY BACKUP / RESTORE (sqlite online backup API) ----------------
+# a backup is each shard's database file, copied page by page with
+# Connection.backup() inside one read transaction: a point-in-time image that
+# (WAL) never blocks writers. One shard -> the .db file itself; several -> a tar
+# of shard<i>.db files. Either may be gzipped. Restores re-route rows through
+# the staging swap, so a backup taken with any shard count restores into any other.
+SQLITE_MAGIC = b"SQLite format 3\x00"
+GZIP_MAGIC = b"\x1f\x8b"
+BACKUP_TABLE_COLUMNS = {
+    "secure_keys": {"package", "key_value", "is_used", "device_id", "last_verified"},
+    "simple_keys": {"key_value", "is_used", "device_id", "last_verified"},
+}
+
+
+def _scratch_file(prefix, suffix=""):
+    # scratch files live next to the DB (same filesystem, usually more room than /tmp)
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix,
+                                dir=os.path.dirname(os.path.abspath(DB_SQLITE_FILE)))
+    os.close(fd)
+    return path
+
+
+def backup_shard(shard, path):
+    """Copy one shard into a standalone sqlite file; returns (change_counter, last change seq)."""
+    src = _open_sqlite(shard)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst)
+        # a self-contained file: no -wal/-shm needed to open it elsewhere
+        dst.execute("PRAGMA journal_mode=DELETE")
+        return get_change_counter(dst), get_last_change_seq(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def write_backup(path):
+    """Back up every shard into path (a .db, or a tar of them when sharded)."""
+    if SQLITE_SHARDS == 1:
+        counter, seq = backup_shard(0, path)
+        return counter, format_change_cursor([seq])
+    counter, seqs = 0, []
+    with tarfile.open(path, "w") as tar:
+        for shard in range(SQLITE_SHARDS):
+            part = _scratch_file(".backup.", ".db")
+            try:
+                c, seq = backup_shard(shard, part)
+                tar.add(part, arcname=f"shard{shard}.db")
+            finally:
+                os.remove(part)
+            counter += c
+            seqs.append(seq)
+    return counter, format_change_cursor(seqs)
+
+
+def check_backup_file(path):
+    """ValueError unless path is an intact sqlite file with both key tables."""
+    try:
+        con = sqlite3.connect(path)
+    except sqlite3.Error as e:
+        raise ValueError(f"cannot open backup: {e}") from e
+    try:
+        problems = [r[0] for r in con.execute("PRAGMA integrity_check")]
+        if problems != ["ok"]:
+            raise ValueError("integrity check failed: " + "; ".join(problems[:5]))
+        for table, cols in BACKUP_TABLE_COLUMNS.items():
+            have = {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+            if not cols <= have:
+                raise ValueError(f"backup has no usable {table} table")
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"not a valid sqlite database: {e}") from e
+    finally:
+        con.close()
+
+
+def unpack_backup(path, scratch):
+    """
+    Paths of the sqlite files inside an uploaded backup (gunzipped / untarred
+    into new scratch files, appended to scratch for cleanup). ValueError if
+    the upload is none of the backup formats.
+    """
+    with open(path, "rb") as f:
+        head = f.read(len(SQLITE_MAGIC))
+    if head.startswith(GZIP_MAGIC):
+        plain = _scratch_file(".restore.")
+        scratch.append(plain)
+        z = zlib.decompressobj(31)
+        try:
+            with open(path, "rb") as src, open(plain, "wb") as dst:
+                for chunk in iter(lambda: src.read(STREAM_CHUNK_SIZE), b""):
+                    dst.write(z.decompress(chunk))
+                dst.write(z.flush())
+        except zlib.error as e:
+            raise ValueError(f"corrupt gzip data: {e}") from e
+        return unpack_backup(plain, scratch)
+    if head == SQLITE_MAGIC:
+        return [path]
+    if tarfile.is_tarfile(path):
+        dbs = []
+        with tarfile.open(path, "r:") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # copied out by content only: member names never become paths
+                part = _scratch_file(".restore.", ".db")
+                scratch.append(part)
+                with tar.extractfile(member) as src, open(part, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                dbs.extend(unpack_backup(part, scratch))
+        if dbs:
+            return dbs
+    raise ValueError("not a sqlite backup (.db, .tar, optionally gzipped)")
+
+
+def stage_sqlite_backup(con, paths):
+    """Copy the key tables of already-checked backup files into the attached staging tables."""
+    con.create_function("shard_for", 2, shard_for, deterministic=True)
+    _create_staging_tables(con)
+    con.commit()
+    counts = {"SIMPLE_KEYS": 0, "SECURE_KEYS": 0}
+    for path in paths:
+        con.execute("ATTACH DATABASE ? AS backup", (path,))
+        try:
+            counts["SIMPLE_KEYS"] += con.execute(
+                "INSERT INTO staging.simple_keys SELECT shard_for(NULL,key_value),key_value,is_used,device_id,last_verified "
+                "FROM backup.simple_keys").rowcount
+            counts["SECURE_KEYS"] += con.execute(
+                "INSERT INTO staging.secure_keys "
+                "SELECT shard_for(package,key_value),package,key_value,is_used,device_id,last_verified "
+                "FROM backup.secure_keys").rowcount
+            con.commit()
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            con.execute("DETACH DATABASE backup")
+    _index_staging_tables(con)
+    return counts
+
+
+@app.before_request
+def _start_request_timer():
+    _stage_timer.__dict__.clear()
+    _stage_timer.started = time.perf_counter()
+    _ensure_sweeper()
+
+
+@app.after_request
+def _access_record(resp):
+    # per-route/per-stage metrics, then a structured, sampled access log record
+    # (formatting and I/O happen on the log listener thread)
+    stages = _stage_timer.__dict__
+    started = stages.pop("started", None)
+    if started is None:
+        return resp
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    outcomes = stages.pop("outcomes", ())
+    metrics.observe_request(route, resp.status_code, elapsed, stages, outcomes)
+
+    latency_ms = elapsed * 1000.0
+    if (resp.status_code >= 500 or latency_ms >= ACCESS_LOG_SLOW_MS
+            or random.random() < ACCESS_LOG_SAMPLE_RATE):
+        access_log.info(json.dumps({
+            "route": route,
+            "method": request.method,
+            "status": resp.status_code,
+            "latency_ms": round(latency_ms, 3),
+            "db_ms": round((stages.get("sqlite_query", 0.0) + stages.get("sqlite_commit", 0.0)) * 1000.0, 3),
+            "pid": os.getpid(),
+        }, separators=(",", ":")))
+    return resp
+
+
+@app.teardown_request
+def _rollback_unfinished(exc):
+    # connections outlive requests now, so never leave a transaction open on them
+    for con in _open_dbs():
+        if con.in_transaction:
+            con.rollback()
 
 
 # ----------------- FORCE DOWNLOAD (preserve original behavior) -----------------
@@ -191,11 +1212,75 @@ def force_download(filepath, filename="keys_db.json"):
     return resp
 
 
-# ---------------- CRYPTO / SIGNATURE (unchanged) ----------------
+# ----------------- STREAMED DB RESPONSE (download_db / list_all) -----------------
+def stream_db_response(indent, sort_keys, filename=None):
+    # the whole document comes from one read transaction on a dedicated
+    # connection, so the ETag and every row belong to the same snapshot
+    flush_heartbeats()
+    cons = open_db_snapshot()
+    use_gzip = "gzip" in request.headers.get("Accept-Encoding", "").lower()
+    etag = f"{total_change_counter(cons)}-{'i' if indent else 'c'}{'-gz' if use_gzip else ''}"
+    # the change_log position this document reflects; poll /changes?since= from here
+    seq = format_change_cursor([get_last_change_seq(con) for con in cons])
+
+    def close():
+        for con in cons:
+            con.close()
+
+    if request.if_none_match.contains(etag):
+        close()
+        resp = make_response("", 304)
+        resp.set_etag(etag)
+        return resp
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+
+    def generate():
+        # runs after the view returned, so its time is observed here directly
+        t0 = time.perf_counter()
+        try:
+            if use_gzip:
+                z = zlib.compressobj(6, zlib.DEFLATED, 31)
+                for chunk in iter_db_json(cons, indent=indent, sort_keys=sort_keys):
+                    data = z.compress(chunk.encode("utf-8"))
+                    if data:
+                        yield data
+                yield z.flush()
+            else:
+                for chunk in iter_db_json(cons, indent=indent, sort_keys=sort_keys):
+                    yield chunk.encode("utf-8")
+        finally:
+            close()
+            metrics.observe_stage(route, "serialize", time.perf_counter() - t0)
+
+    resp = Response(generate(), mimetype="application/octet-stream" if filename else "application/json")
+    if filename:
+        resp.headers.set("Content-Disposition", f"attachment; filename={filename}")
+    if use_gzip:
+        resp.headers.set("Content-Encoding", "gzip")
+    resp.headers.set("Vary", "Accept-Encoding")
+    resp.headers.set("X-Change-Seq", str(seq))
+    resp.set_etag(etag)
+    return resp
+
+
+# ---------------- CRYPTO / SIGNATURE ----------------
+SIG_CACHE_SIZE = int(os.environ.get("SIG_CACHE_SIZE", "1024"))
+_XOR_KEY = XOR_KEY_STRING.encode("utf-8")
+
+
+def _xor_bytes(raw: bytes) -> bytes:
+    # whole-buffer XOR with the repeating key as one big-int operation
+    n = len(raw)
+    if not n:
+        return b""
+    stream = (_XOR_KEY * -(-n // len(_XOR_KEY)))[:n]
+    return (int.from_bytes(raw, "big") ^ int.from_bytes(stream, "big")).to_bytes(n, "big")
+
+
 def custom_decrypt(encoded_text: str) -> str:
     if not encoded_text:
         return ""
-    key = XOR_KEY_STRING.encode("utf-8")
     missing = len(encoded_text) % 4
     if missing:
         encoded_text += "=" * (4 - missing)
@@ -203,10 +1288,22 @@ def custom_decrypt(encoded_text: str) -> str:
         raw = base64.b64decode(encoded_text)
     except Exception:
         return ""
-    return "".join(chr(raw[i] ^ key[i % len(key)]) for i in range(len(raw)))
+    # latin-1 maps every byte to the same code point, i.e. the old chr() per byte
+    return _xor_bytes(raw).decode("latin-1")
 
 
-def verify_signature(sig_enc: str) -> bool:
+def _expected_sig_forms():
+    # the encrypted form(s) a well-behaved client sends: with and without padding
+    plain = EXPECTED_SIGNATURE.strip().rstrip("=")
+    enc = base64.b64encode(_xor_bytes(plain.encode("latin-1"))).decode("ascii")
+    return tuple({enc.encode("ascii"), enc.rstrip("=").encode("ascii")})
+
+
+EXPECTED_SIG_FORMS = _expected_sig_forms()
+
+
+@functools.lru_cache(maxsize=SIG_CACHE_SIZE)
+def _verify_signature_slow(sig_enc: str) -> bool:
     try:
         dec = custom_decrypt(sig_enc)
         # match original logic: strip and rstrip "="
@@ -215,6 +1312,839 @@ def verify_signature(sig_enc: str) -> bool:
         return False
 
 
+def verify_signature(sig_enc: str) -> bool:
+    t0 = time.perf_counter()
+    try:
+        try:
+            sig_bytes = sig_enc.encode("utf-8")
+        except Exception:
+            return False
+        # common case: the exact precomputed form, compared in constant time
+        for form in EXPECTED_SIG_FORMS:
+            if hmac.compare_digest(sig_bytes, form):
+                return True
+        # anything else (odd padding, whitespace, garbage) is decoded once and memoized
+        return _verify_signature_slow(sig_enc)
+    finally:
+        _charge_stage("signature", t0)
+
+
+# ---------------- KEY BINDING CACHE (read-through, per process) ----------------
+KEY_CACHE_SIZE = int(os.environ.get("KEY_CACHE_SIZE", "50000"))     # 0 disables the cache
+# seconds a cached holder may re-verify without touching sqlite; last_verified
+# then lags by up to this much (0 = refresh the row on every verification)
+KEY_CACHE_REFRESH_LAG = float(os.environ.get("KEY_CACHE_REFRESH_LAG", "0"))
+# bumped by every admin write so other gunicorn workers drop their caches too:
+# an 8-byte counter, mapped shared by every worker. Not the file's mtime: two
+# bumps inside one timestamp tick (coarse ext4/NFS clocks) must still differ
+DB_GENERATION_FILE = DB_SQLITE_FILE + ".gen"
+
+
+class KeyBindingCache:
+    """Bounded LRU of (package, key) -> (is_used, device_id, refreshed_at)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, package, key):
+        if self.maxsize <= 0:
+            return None
+        with self._lock:
+            entry = self._data.get((package or "", key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end((package or "", key))
+            self.hits += 1
+            return entry
+
+    def put(self, package, key, is_used, device_id, refreshed_at):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[(package or "", key)] = (bool(is_used), device_id, refreshed_at)
+            self._data.move_to_end((package or "", key))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, package, keys):
+        with self._lock:
+            for k in keys:
+                self._data.pop((package or "", k), None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / total) if total else 0.0,
+                "refresh_lag": KEY_CACHE_REFRESH_LAG,
+            }
+
+
+key_cache = KeyBindingCache(KEY_CACHE_SIZE)
+
+
+_generation_map = None
+
+
+def _db_generation_map():
+    global _generation_map
+    if _generation_map is None:
+        with open(DB_GENERATION_FILE, "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_size < 8:
+                    f.truncate(8)
+            finally:
+                # explicitly: the mapping keeps a dup of this descriptor (and its lock) open
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            _generation_map = mmap.mmap(f.fileno(), 8)
+    return _generation_map
+
+
+def read_db_generation():
+    return struct.unpack_from("<Q", _db_generation_map())[0]
+
+
+def bump_db_generation():
+    # tell every worker (including this one) that cached bindings may be stale
+    try:
+        gen_map = _db_generation_map()
+        with open(DB_GENERATION_FILE, "r+b") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            struct.pack_into("<Q", gen_map, 0, read_db_generation() + 1)
+    except (OSError, ValueError):
+        logging.exception("Failed to bump DB generation file")
+
+
+def invalidate_keys(package, keys):
+    key_cache.discard(package, keys)
+    bump_db_generation()
+
+
+def invalidate_all_keys():
+    key_cache.clear()
+    key_filter.reset()
+    bump_db_generation()
+    token_revocations.revoke_all()
+
+
+_seen_generation = None
+_generation_lock = threading.Lock()
+
+
+def sync_db_generation():
+    # one read of the shared mapping per verification is far cheaper than a
+    # sqlite round trip; when another worker (or this one) changed keys, drop
+    # the cache and let the key filter pick up the new keys from the change log
+    global _seen_generation
+    try:
+        gen = read_db_generation()
+    except (OSError, ValueError):
+        gen = None
+    if gen == _seen_generation:
+        return
+    with _generation_lock:
+        if gen == _seen_generation:
+            return
+        key_cache.clear()
+        key_filter.catch_up()
+        _seen_generation = gen
+
+
+# ---------------- NEGATIVE-LOOKUP FILTER (Bloom, per process) ----------------
+# rejects keys that are definitely unknown before sqlite is touched. Bloom
+# filters cannot delete, so deleted keys stay "maybe present" and simply fall
+# through to sqlite; the filter is rebuilt after a restore or log compaction.
+KEY_FILTER_ENABLED = os.environ.get("KEY_FILTER_ENABLED", "1") != "0"
+KEY_FILTER_FP_RATE = float(os.environ.get("KEY_FILTER_FP_RATE", "0.01"))
+KEY_FILTER_MIN_CAPACITY = 100000
+
+
+class KeyFilter:
+    """Bloom filter over every (package, key_value); False means definitely unknown."""
+
+    def __init__(self, fp_rate, min_capacity):
+        self.fp_rate = fp_rate
+        self.min_capacity = min_capacity
+        self.count = 0          # keys added (deletes are not subtracted)
+        self.seqs = [0] * SQLITE_SHARDS     # change_log position (per shard) the filter reflects
+        self.checked = 0
+        self.rejected = 0
+        self._bits = None       # None = not built yet, every key "maybe present"
+        self._m = 0
+        self._k = 0
+        self._lock = threading.Lock()
+        self._building = False
+
+    @staticmethod
+    def _hashes(package, key):
+        h = hashlib.blake2b(f"{package or ''}\x00{key}".encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        return int.from_bytes(h[:8], "little"), int.from_bytes(h[8:], "little") | 1
+
+    def _set(self, bits, m, k, package, key):
+        h1, h2 = self._hashes(package, key)
+        for i in range(k):
+            pos = (h1 + i * h2) % m
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, package, key):
+        if not KEY_FILTER_ENABLED:
+            return True
+        bits, m, k = self._bits, self._m, self._k
+        if bits is None:
+            self._start_build()
+            return True
+        self.checked += 1
+        h1, h2 = self._hashes(package, key)
+        for i in range(k):
+            pos = (h1 + i * h2) % m
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                self.rejected += 1
+                return False
+        return True
+
+    def add(self, package, keys):
+        # makes keys visible to this worker right away; they are counted when
+        # catch_up() replays the same inserts from the change log
+        with self._lock:
+            if self._bits is None:
+                return
+            for key in keys:
+                self._set(self._bits, self._m, self._k, package, key)
+
+    def reset(self):
+        with self._lock:
+            self._bits = None
+
+    def _capacity(self):
+        # n the filter was sized for: m = -n ln p / (ln 2)^2
+        return int(self._m * (math.log(2) ** 2) / -math.log(self.fp_rate)) if self._m else 0
+
+    def _start_build(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._build, name="key-filter-build", daemon=True).start()
+
+    def _build(self):
+        cons = []
+        try:
+            # one read snapshot per shard: its seq and its scanned rows agree
+            cons = open_db_snapshot()
+            seqs = [get_last_change_seq(con) for con in cons]
+            n = sum(con.execute("SELECT COUNT(*) FROM secure_keys").fetchone()[0]
+                    + con.execute("SELECT COUNT(*) FROM simple_keys").fetchone()[0] for con in cons)
+            n = max(self.min_capacity, int(n * 1.5))
+            m = max(64, int(-n * math.log(self.fp_rate) / (math.log(2) ** 2)))
+            k = max(1, round(m / n * math.log(2)))
+            bits = bytearray((m + 7) // 8)
+            count = 0
+            for con in cons:
+                for pkg, key in con.execute("SELECT package,key_value FROM secure_keys"):
+                    self._set(bits, m, k, pkg, key)
+                    count += 1
+                for (key,) in con.execute("SELECT key_value FROM simple_keys"):
+                    self._set(bits, m, k, None, key)
+                    count += 1
+            with self._lock:
+                self._bits, self._m, self._k = bits, m, k
+                self.count, self.seqs = count, seqs
+        except Exception:
+            logging.exception("Key filter build failed")
+        finally:
+            for con in cons:
+                con.close()
+            with self._lock:
+                self._building = False
+        # apply anything that changed while scanning
+        self.catch_up()
+
+    def catch_up(self):
+        """Add keys inserted since the filter's change_log position."""
+        if self._bits is None:
+            return
+        pending = []
+        for shard, con in enumerate(all_dbs()):
+            floor = con.execute("SELECT value FROM db_meta WHERE name='changelog_floor'").fetchone()[0]
+            rows = con.execute("SELECT seq,op,package,key_value FROM change_log WHERE seq>? ORDER BY seq",
+                               (self.seqs[shard],)).fetchall()
+            if self.seqs[shard] < floor or any(op == "reset" for _, op, _, _ in rows):
+                # the log can't bring us up to date: rebuild from the tables
+                self.reset()
+                self._start_build()
+                return
+            pending.append((shard, rows))
+        with self._lock:
+            if self._bits is None:
+                return
+            for shard, rows in pending:
+                for seq, op, pkg, key in rows:
+                    if op == "insert":
+                        self._set(self._bits, self._m, self._k, pkg, key)
+                        self.count += 1
+                    self.seqs[shard] = seq
+            if self.count > self._capacity() * 2:
+                # far past its sizing: the fp rate degrades, rebuild bigger
+                self._bits = None
+
+    def stats(self):
+        m, k, n = self._m, self._k, self.count
+        est_fp = (1 - math.exp(-k * n / m)) ** k if m and k else None
+        return {
+            "enabled": KEY_FILTER_ENABLED,
+            "ready": self._bits is not None,
+            "keys": n,
+            "capacity": self._capacity(),
+            "bits": m,
+            "hashes": k,
+            "memory_bytes": len(self._bits) if self._bits is not None else 0,
+            "target_fp_rate": self.fp_rate,
+            "estimated_fp_rate": est_fp,
+            "checked": self.checked,
+            "rejected": self.rejected,
+            "change_seq": format_change_cursor(self.seqs),
+        }
+
+
+key_filter = KeyFilter(KEY_FILTER_FP_RATE, KEY_FILTER_MIN_CAPACITY)
+
+
+# ---------------- HEARTBEAT GROUP COMMIT ----------------
+# when > 0, a verification that only moves last_verified (binding unchanged) is
+# buffered and written with many others in one transaction every this many
+# seconds; new bindings still commit immediately. 0 = commit every refresh.
+HEARTBEAT_FLUSH_INTERVAL = float(os.environ.get("HEARTBEAT_FLUSH_INTERVAL", "0"))
+HEARTBEAT_FLUSH_MAX = int(os.environ.get("HEARTBEAT_FLUSH_MAX", "1000"))   # flush early at this many keys
+
+# conditional on the holder so a heartbeat can never resurrect a released/rebound key
+SQL_HEARTBEAT_SECURE = ("UPDATE secure_keys SET last_verified=? "
+                        "WHERE package=? AND key_value=? AND is_used=1 AND device_id=?")
+SQL_HEARTBEAT_SIMPLE = ("UPDATE simple_keys SET last_verified=? "
+                        "WHERE key_value=? AND is_used=1 AND device_id=?")
+
+_heartbeats = {}                        # (package or "", key) -> (device_id, ts)
+_heartbeat_lock = threading.Lock()
+_heartbeat_full = threading.Event()     # size threshold hit, flush without waiting
+_heartbeat_thread = None
+_heartbeat_thread_lock = threading.Lock()
+
+
+def buffer_heartbeat(package, key, device_id, ts):
+    with _heartbeat_lock:
+        _heartbeats[(package or "", key)] = (device_id, ts)
+        pending = len(_heartbeats)
+    _ensure_heartbeat_flusher()
+    if pending >= HEARTBEAT_FLUSH_MAX:
+        _heartbeat_full.set()
+
+
+def flush_heartbeats():
+    """Write all buffered last_verified refreshes in a single transaction per shard."""
+    global _heartbeats
+    with _heartbeat_lock:
+        if not _heartbeats:
+            return 0
+        pending, _heartbeats = _heartbeats, {}
+
+    by_shard = {}
+    for (pkg, k), v in pending.items():
+        by_shard.setdefault(shard_for(pkg or None, k), {})[(pkg, k)] = v
+    written = 0
+    for shard, batch in sorted(by_shard.items()):
+        secure = [(ts, pkg, k, dev) for (pkg, k), (dev, ts) in batch.items() if pkg]
+        simple = [(ts, k, dev) for (pkg, k), (dev, ts) in batch.items() if not pkg]
+
+        def write():
+            con = get_db(shard)
+            try:
+                if secure:
+                    con.executemany(SQL_HEARTBEAT_SECURE, secure)
+                if simple:
+                    con.executemany(SQL_HEARTBEAT_SIMPLE, simple)
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+
+        try:
+            run_write(write)
+        except Exception:
+            logging.exception("Heartbeat flush failed, %d refreshes re-queued", len(batch))
+            with _heartbeat_lock:
+                for k, v in batch.items():
+                    _heartbeats.setdefault(k, v)
+            continue
+        written += len(batch)
+    if written:
+        mark_snapshot_dirty()
+    return written
+
+
+def _heartbeat_flusher_loop():
+    while True:
+        _heartbeat_full.wait(HEARTBEAT_FLUSH_INTERVAL)
+        _heartbeat_full.clear()
+        try:
+            flush_heartbeats()
+        except Exception:
+            logging.exception("Background heartbeat flush failed")
+
+
+def _ensure_heartbeat_flusher():
+    global _heartbeat_thread
+    if _heartbeat_thread is not None and _heartbeat_thread.is_alive():
+        return
+    with _heartbeat_thread_lock:
+        if _heartbeat_thread is None or not _heartbeat_thread.is_alive():
+            _heartbeat_thread = threading.Thread(target=_heartbeat_flusher_loop,
+                                                 name="heartbeat-flusher", daemon=True)
+            _heartbeat_thread.start()
+
+
+# registered after the snapshot flush, so (atexit being LIFO) it runs first
+atexit.register(flush_heartbeats)
+
+
+# ---------------- STALE BINDING SWEEPER ----------------
+# when BINDING_TTL_SECONDS > 0, a background thread releases bindings whose
+# last_verified is older than the TTL, in small transactions so verifications
+# never wait long behind it. Every worker runs the timer, but a round is one
+# sweep: under the file lock, a worker skips if db_meta says another worker swept
+# within the interval.
+BINDING_TTL_SECONDS = float(os.environ.get("BINDING_TTL_SECONDS", "0"))
+SWEEP_INTERVAL_SECONDS = float(os.environ.get("SWEEP_INTERVAL_SECONDS", "300"))
+SWEEP_BATCH_SIZE = int(os.environ.get("SWEEP_BATCH_SIZE", "500"))
+SWEEP_LOCK_FILE = DB_SQLITE_FILE + ".sweep.lock"
+
+SQL_RELEASE_STALE_SECURE = (
+    "UPDATE secure_keys SET is_used=0,device_id=NULL,last_verified=NULL "
+    "WHERE rowid IN (SELECT rowid FROM secure_keys WHERE is_used=1 AND last_verified<? LIMIT ?) "
+    "RETURNING package,key_value")
+SQL_RELEASE_STALE_SIMPLE = (
+    "UPDATE simple_keys SET is_used=0,device_id=NULL,last_verified=NULL "
+    "WHERE rowid IN (SELECT rowid FROM simple_keys WHERE is_used=1 AND last_verified<? LIMIT ?) "
+    "RETURNING NULL,key_value")
+
+_sweeper_thread = None
+_sweeper_thread_lock = threading.Lock()
+
+
+def release_stale_bindings(older_than, batch_size=SWEEP_BATCH_SIZE):
+    """Free every binding not verified for older_than seconds. Returns the number released."""
+    # buffered refreshes first, so a key that is still heartbeating isn't released
+    flush_heartbeats()
+    cutoff = time.time() - older_than
+    released = 0
+
+    def release(shard, sql):
+        con = get_db(shard)
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            rows = con.execute(sql, (cutoff, batch_size)).fetchall()
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        return rows
+
+    for shard in range(SQLITE_SHARDS):
+        for sql in (SQL_RELEASE_STALE_SECURE, SQL_RELEASE_STALE_SIMPLE):
+            while True:
+                rows = run_write(lambda: release(shard, sql))
+                for pkg, key in rows:
+                    key_cache.discard(pkg, [key])
+                    token_revocations.revoke(pkg, [key])
+                released += len(rows)
+                if len(rows) < batch_size:
+                    break
+    if released:
+        bump_db_generation()
+        mark_snapshot_dirty()
+    return released
+
+
+def _claim_sweep_round():
+    # last_sweep (shard 0) is shared by all workers; timers drift, so allow 10% slack
+    def write():
+        con = get_db(0)
+        now = int(time.time())
+        row = con.execute("SELECT value FROM db_meta WHERE name='last_sweep'").fetchone()
+        if row is not None and now - row[0] < SWEEP_INTERVAL_SECONDS * 0.9:
+            return False
+        con.execute("INSERT OR REPLACE INTO db_meta(name,value) VALUES('last_sweep',?)", (now,))
+        con.commit()
+        return True
+
+    return run_write(write)
+
+
+def _sweeper_loop():
+    while True:
+        time.sleep(SWEEP_INTERVAL_SECONDS)
+        try:
+            with open(SWEEP_LOCK_FILE, "a") as lock:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue    # another worker is sweeping right now
+                if not _claim_sweep_round():
+                    continue        # another worker already swept this round
+                n = release_stale_bindings(BINDING_TTL_SECONDS)
+                if n:
+                    logging.info("Released %d bindings idle for more than %ss", n, BINDING_TTL_SECONDS)
+        except Exception:
+            logging.exception("Stale binding sweep failed")
+
+
+def _ensure_sweeper():
+    global _sweeper_thread
+    # started lazily (from the first request) so every gunicorn worker has its own
+    if BINDING_TTL_SECONDS <= 0 or (_sweeper_thread is not None and _sweeper_thread.is_alive()):
+        return
+    with _sweeper_thread_lock:
+        if _sweeper_thread is None or not _sweeper_thread.is_alive():
+            _sweeper_thread = threading.Thread(target=_sweeper_loop, name="binding-sweeper", daemon=True)
+            _sweeper_thread.start()
+
+
+# ---------------- KEY VERIFICATION ENGINE (shared by /keys and /ids) ----------------
+VERIFY_OK = "ok"
+VERIFY_UNKNOWN = "unknown"      # no such key (or key/package pair)
+VERIFY_CONFLICT = "conflict"    # key is bound to another device
+
+
+# set by asyncserver.py: sends single verifications to its writer thread, which
+# commits concurrent ones together (same arguments and result as _verify_key_binding)
+verify_delegate = None
+# set by asyncserver.py as well: runs a write transaction (fn) on that same thread.
+# Only the transaction goes there; snapshot rewrites and responses stay with the caller.
+# Every commit to the live shards goes through run_write, except the schema setup
+# and default load at startup (before any server runs) and the restore staging,
+# which only writes the scratch staging file
+write_delegate = None
+
+
+def run_write(fn):
+    """Run fn(), a self-contained write transaction, where writes belong; returns its result."""
+    if write_delegate is not None:
+        return write_delegate(fn)
+    return fn()
+
+
+def verify_key_binding(package, key, device_id):
+    """
+    Bind key to device_id, or refresh last_verified if it already holds it.
+    package=None means simple_keys. Returns one of the VERIFY_* outcomes.
+    """
+    if verify_delegate is not None:
+        outcome, wrote = verify_delegate(package, key, device_id)
+    else:
+        outcome, wrote = _verify_key_binding(package, key, device_id, True)
+    note_outcome(outcome)
+    if wrote:
+        mark_snapshot_dirty()
+    return outcome
+
+
+def _verify_key_binding(package, key, device_id, commit):
+    # (outcome, wrote): wrote is True when a row changed. commit=False leaves
+    # the transaction open so a batch can commit once
+    now = time.time()
+    sync_db_generation()
+    cached = key_cache.get(package, key)
+    if cached is not None:
+        is_used, holder, refreshed_at = cached
+        if is_used and holder != device_id:
+            return VERIFY_CONFLICT, False
+        if is_used and now - refreshed_at < KEY_CACHE_REFRESH_LAG:
+            # same device re-verifying within the lag window: skip sqlite entirely
+            return VERIFY_OK, False
+        holder_known = bool(is_used)
+    else:
+        if not key_filter.might_contain(package, key):
+            # definitely not a key we have: no sqlite work at all
+            return VERIFY_UNKNOWN, False
+        holder_known = False
+
+    con = get_db(shard_for(package, key))
+    if HEARTBEAT_FLUSH_INTERVAL > 0:
+        if not holder_known:
+            if package:
+                row = con.execute(SQL_SELECT_SECURE, (package, key)).fetchone()
+            else:
+                row = con.execute(SQL_SELECT_SIMPLE, (key,)).fetchone()
+            if not row:
+                return VERIFY_UNKNOWN, False
+            if row[0] and row[1] != device_id:
+                key_cache.put(package, key, row[0], row[1], now)
+                return VERIFY_CONFLICT, False
+            holder_known = bool(row[0])
+        if holder_known:
+            # binding unchanged, only last_verified moves: leave it to the group commit
+            buffer_heartbeat(package, key, device_id, now)
+            key_cache.put(package, key, True, device_id, now)
+            return VERIFY_OK, False
+
+    if package:
+        cur = con.execute(SQL_BIND_SECURE, (device_id, now, package, key, device_id))
+    else:
+        cur = con.execute(SQL_BIND_SIMPLE, (device_id, now, key, device_id))
+
+    if cur.rowcount == 1:
+        if commit:
+            con.commit()
+        key_cache.put(package, key, True, device_id, now)
+        return VERIFY_OK, True
+    if commit:
+        con.rollback()
+
+    # nothing updated: only now find out whether the key exists at all
+    if package:
+        row = con.execute(SQL_SELECT_SECURE, (package, key)).fetchone()
+    else:
+        row = con.execute(SQL_SELECT_SIMPLE, (key,)).fetchone()
+    if row:
+        key_cache.put(package, key, row[0], row[1], now)
+    return (VERIFY_CONFLICT if row else VERIFY_UNKNOWN), False
+
+
+def _keys_result(outcome, is_secure):
+    # /keys response body and status for a verification outcome
+    if outcome == VERIFY_UNKNOWN:
+        return {"error": "Invalid key or package (secure mode)" if is_secure else "Invalid simple key"}, 401
+    if outcome == VERIFY_CONFLICT:
+        return {"error": "Key already in use by another device"}, 403
+    return {"success": True, "message": "Key verified/registered"}, 200
+
+
+# ---------------- VERIFICATION TOKENS (stateless re-checks) ----------------
+# when VERIFY_TOKEN_TTL_SECONDS > 0, successful /keys and /ids responses carry
+# a short-lived HMAC token bound to (package, key, device_id). /verify_token
+# checks it with CPU work only. Deleting a key or releasing its binding revokes
+# tokens issued before that moment: revocations are appended to a small file
+# every worker tails (one stat() per check), and entries older than the TTL
+# are dropped, since every token they could match has expired anyway.
+VERIFY_TOKEN_TTL_SECONDS = float(os.environ.get("VERIFY_TOKEN_TTL_SECONDS", "0"))
+# shared by all workers; generated into VERIFY_TOKEN_KEY_FILE when not set
+VERIFY_TOKEN_SECRET = os.environ.get("VERIFY_TOKEN_SECRET", "")
+VERIFY_TOKEN_KEY_FILE = DB_SQLITE_FILE + ".token_key"
+REVOCATION_FILE = DB_SQLITE_FILE + ".revoked"
+REVOCATION_FILE_MAX_BYTES = 1024 * 1024     # rewritten without expired entries past this
+TOKEN_VERSION = "v1"
+TOKEN_MAC_BYTES = 16
+
+
+def _load_token_secret():
+    if VERIFY_TOKEN_SECRET:
+        return VERIFY_TOKEN_SECRET.encode("utf-8")
+    try:
+        # first worker to get here creates it; everyone else reads the same bytes
+        fd = os.open(VERIFY_TOKEN_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(VERIFY_TOKEN_KEY_FILE, "rb") as f:
+                secret = f.read()
+            if len(secret) == 32:
+                return secret
+            time.sleep(0.01)    # creator hasn't finished writing yet
+        raise RuntimeError(f"{VERIFY_TOKEN_KEY_FILE} is not a valid token key")
+    secret = os.urandom(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+
+_token_secret = None
+
+
+def _token_mac(issued_ms, package, key, device_id):
+    global _token_secret
+    if _token_secret is None:
+        _token_secret = _load_token_secret()
+    msg = json.dumps([TOKEN_VERSION, issued_ms, package or "", key, device_id]).encode("utf-8")
+    return hmac.new(_token_secret, msg, hashlib.sha256).digest()[:TOKEN_MAC_BYTES]
+
+
+def issue_verify_token(package, key, device_id, issued_at):
+    """Token for a binding verified at issued_at (taken before the check, so a concurrent delete wins)."""
+    issued_ms = int(issued_at * 1000)
+    mac = base64.urlsafe_b64encode(_token_mac(issued_ms, package, key, device_id)).rstrip(b"=")
+    return f"{TOKEN_VERSION}.{issued_ms}.{mac.decode('ascii')}"
+
+
+class TokenRevocations:
+    """Per-process view of REVOCATION_FILE: (package, key) -> revoked_at, plus a revoke-everything time."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file_id = None
+        self._offset = 0
+        self._keys = {}
+        self._all_before = 0.0
+        self._unrecorded_before = 0.0   # local fallback when the file can't be written
+        self._pruned_at = time.time()
+
+    def revoke(self, package, keys, revoked_at=None):
+        if VERIFY_TOKEN_TTL_SECONDS <= 0 or not keys:
+            return
+        ts = time.time() if revoked_at is None else revoked_at
+        self._append("".join(json.dumps([ts, package or "", k]) + "\n" for k in keys))
+
+    def revoke_all(self):
+        if VERIFY_TOKEN_TTL_SECONDS <= 0:
+            return
+        self._append(json.dumps([time.time(), None, None]) + "\n")
+
+    def is_revoked(self, package, key, issued_at):
+        self.sync()
+        with self._lock:
+            if issued_at <= max(self._all_before, self._unrecorded_before):
+                return True
+            revoked_at = self._keys.get((package or "", key))
+            return revoked_at is not None and issued_at <= revoked_at
+
+    def sync(self):
+        # pick up revocations appended by any worker since the last check
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        file_id = (st.st_dev, st.st_ino)
+        if file_id == self._file_id and st.st_size == self._offset:
+            return
+        with self._lock:
+            if file_id != self._file_id or st.st_size < self._offset:
+                # first look, or the file was compacted: rebuild from it
+                self._file_id, self._offset = file_id, 0
+                self._keys.clear()
+                self._all_before = 0.0
+            try:
+                with open(self.path, "rb") as f:
+                    f.seek(self._offset)
+                    data = f.read()
+            except OSError:
+                return
+            # an append still in progress has no trailing newline yet
+            data = data[:data.rfind(b"\n") + 1]
+            self._offset += len(data)
+            for line in data.splitlines():
+                try:
+                    ts, package, key = json.loads(line)
+                except ValueError:
+                    continue
+                if key is None:
+                    self._all_before = max(self._all_before, ts)
+                elif ts > self._keys.get((package, key), 0.0):
+                    self._keys[(package, key)] = ts
+            self._prune()
+
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned_at >= VERIFY_TOKEN_TTL_SECONDS:
+            horizon = now - VERIFY_TOKEN_TTL_SECONDS
+            self._keys = {k: ts for k, ts in self._keys.items() if ts >= horizon}
+            self._pruned_at = now
+
+    def _append(self, text):
+        try:
+            # the lock is its own file: _compact replaces the data file, and a writer
+            # queued on the old inode would append where no reader ever looks
+            with open(self.path + ".lock", "a") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(text)
+                    f.flush()
+                    size = f.tell()
+                if size > REVOCATION_FILE_MAX_BYTES:
+                    self._compact()
+        except OSError:
+            # a lost revocation would leave tokens valid for a deleted key: drop all of them instead
+            logging.exception("Failed to record token revocation")
+            self._unrecorded_before = time.time()
+
+    def _compact(self):
+        # called with the file lock held: keep only entries a live token could still match
+        horizon = time.time() - VERIFY_TOKEN_TTL_SECONDS
+        with open(self.path, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+        keep = []
+        for line in lines:
+            try:
+                if json.loads(line)[0] >= horizon:
+                    keep.append(line)
+            except ValueError:
+                continue
+        fd, tmp = tempfile.mkstemp(prefix=".revoked.", dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "wb") as f:
+            f.writelines(keep)
+        os.replace(tmp, self.path)
+
+
+token_revocations = TokenRevocations(REVOCATION_FILE)
+
+
+def check_verify_token(token, package, key, device_id):
+    """None if token is a live token for this binding, else the error message."""
+    try:
+        version, issued, mac = token.split(".")
+        issued_ms = int(issued)
+        mac = base64.urlsafe_b64decode(mac + "=" * (-len(mac) % 4))
+    except (ValueError, TypeError):
+        return "Invalid token"
+    if version != TOKEN_VERSION or not hmac.compare_digest(mac, _token_mac(issued_ms, package, key, device_id)):
+        return "Invalid token"
+    issued_at = issued_ms / 1000.0
+    if time.time() >= issued_at + VERIFY_TOKEN_TTL_SECONDS:
+        return "Token expired"
+    if token_revocations.is_revoked(package, key, issued_at):
+        return "Token revoked"
+    return None
+
+
+# ----------------- bulk helpers (add_keys / delete_keys) -----------------
+def _stage_bulk_keys(con, keys):
+    # stage the request's keys in a per-connection temp table so the bulk
+    # routes can work with set-based joins instead of one statement per key
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_keys (key_value TEXT PRIMARY KEY)")
+    con.execute("DELETE FROM bulk_keys")
+    con.executemany("INSERT OR IGNORE INTO bulk_keys(key_value) VALUES(?)", ((k,) for k in keys))
+
+
+def _keys_by_shard(package, keys):
+    # a package lives on one shard; simple keys are spread by key
+    if package or SQLITE_SHARDS == 1:
+        return {shard_for(package, None if package else keys[0]): keys}
+    out = {}
+    for k in keys:
+        out.setdefault(shard_for(None, k), []).append(k)
+    return out
+
+
+def _wants_diff(data):
+    # opt-in compact response; the full keys_db.json download stays the default
+    return data.get("response") == "diff" or request.args.get("response") == "diff"
+
+
 # ----------------- API: add_keys (bulk) -----------------
 @app.route("/add_keys", methods=["POST"])
 def add_keys():
@@ -230,20 +2160,51 @@ def add_keys():
     keys = data.get("keys")
     if not keys or not isinstance(keys, list):
         return jsonify({"error": "Provide 'keys' as a non-empty list"}), 400
-
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
-
-    if not package:
-        for k in keys:
-            cur.execute("INSERT OR IGNORE INTO simple_keys(key_value,is_used,device_id,last_verified) VALUES(?,0,NULL,NULL)", (k,))
-    else:
-        for k in keys:
-            cur.execute("INSERT OR IGNORE INTO secure_keys(package,key_value,is_used,device_id,last_verified) VALUES(?,?,?,?,?)",
-                        (package, k, 0, None, None))
-
-    con.commit()
-    con.close()
+    # sqlite hands back strings; anything else would never match in the diff response
+    if not all(isinstance(k, str) and k for k in keys):
+        return jsonify({"error": "Every key must be a non-empty string"}), 400
+    keys = list(dict.fromkeys(keys))
+
+    existing = set()
+
+    def write():
+        for shard, shard_keys in sorted(_keys_by_shard(package, keys).items()):
+            con = get_db(shard)
+            try:
+                # take the write lock up front: a deferred transaction that read first
+                # cannot upgrade under WAL once another worker has committed (SQLITE_BUSY)
+                con.execute("BEGIN IMMEDIATE")
+                _stage_bulk_keys(con, shard_keys)
+                if not package:
+                    existing.update(r[0] for r in con.execute(
+                        "SELECT b.key_value FROM bulk_keys b JOIN simple_keys s ON s.key_value=b.key_value"))
+                    con.execute("INSERT OR IGNORE INTO simple_keys(key_value,is_used,device_id,last_verified) "
+                                "SELECT key_value,0,NULL,NULL FROM bulk_keys")
+                else:
+                    existing.update(r[0] for r in con.execute(
+                        "SELECT b.key_value FROM bulk_keys b JOIN secure_keys s "
+                        "ON s.package=? AND s.key_value=b.key_value", (package,)))
+                    con.execute("INSERT OR IGNORE INTO secure_keys(package,key_value,is_used,device_id,last_verified) "
+                                "SELECT ?,key_value,0,NULL,NULL FROM bulk_keys", (package,))
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+
+    run_write(write)
+    key_filter.add(package, keys)
+    invalidate_keys(package, keys)
+
+    if _wants_diff(data):
+        added = [k for k in keys if k not in existing]
+        already = [k for k in keys if k in existing]
+        mark_snapshot_dirty()
+        return jsonify({
+            "success": True,
+            "added": added,
+            "already_present": already,
+            "counts": {"added": len(added), "already_present": len(already)},
+        }), 200
 
     # update json snapshot to maintain original behaviour for downloads
     update_snapshot_from_sqlite()
@@ -265,42 +2226,56 @@ def delete_keys():
     keys = data.get("keys")
     if not keys or not isinstance(keys, list):
         return jsonify({"error": "Provide 'keys' as a non-empty list"}), 400
+    # sqlite hands back strings; anything else would never match in the diff response
+    if not all(isinstance(k, str) and k for k in keys):
+        return jsonify({"error": "Every key must be a non-empty string"}), 400
+    keys = list(dict.fromkeys(keys))
 
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
-
-    deleted = []
-    not_found = []
-
-    if not package:
-        for k in keys:
-            cur.execute("SELECT 1 FROM simple_keys WHERE key_value=?", (k,))
-            if cur.fetchone():
-                cur.execute("DELETE FROM simple_keys WHERE key_value=?", (k,))
-                deleted.append(k)
-            else:
-                not_found.append(k)
-    else:
-        cur.execute("SELECT 1 FROM secure_keys WHERE package=?", (package,))
+    if package:
         # if package not found -> 404 like original expectation
-        cur.execute("SELECT COUNT(*) FROM secure_keys WHERE package=?", (package,))
-        if cur.fetchone()[0] == 0:
-            con.close()
+        con = get_db(shard_for(package, None))
+        if not con.execute("SELECT 1 FROM secure_keys WHERE package=? LIMIT 1", (package,)).fetchone():
             return jsonify({"error": "Package not found in SECURE_KEYS"}), 404
 
-        for k in keys:
-            cur.execute("SELECT 1 FROM secure_keys WHERE package=? AND key_value=?", (package, k))
-            if cur.fetchone():
-                cur.execute("DELETE FROM secure_keys WHERE package=? AND key_value=?", (package, k))
-                deleted.append(k)
-            else:
-                not_found.append(k)
-
-        # remove package entry if empty (in sqlite that's automatic)
-        # but ensure any zero rows remain not present
-
-    con.commit()
-    con.close()
+    found = set()
+
+    def write():
+        for shard, shard_keys in sorted(_keys_by_shard(package, keys).items()):
+            con = get_db(shard)
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                _stage_bulk_keys(con, shard_keys)
+                if not package:
+                    found.update(r[0] for r in con.execute(
+                        "SELECT b.key_value FROM bulk_keys b JOIN simple_keys s ON s.key_value=b.key_value"))
+                    con.execute("DELETE FROM simple_keys WHERE key_value IN (SELECT key_value FROM bulk_keys)")
+                else:
+                    found.update(r[0] for r in con.execute(
+                        "SELECT b.key_value FROM bulk_keys b JOIN secure_keys s "
+                        "ON s.package=? AND s.key_value=b.key_value", (package,)))
+                    # remove package entry if empty (in sqlite that's automatic)
+                    con.execute("DELETE FROM secure_keys WHERE package=? AND key_value IN (SELECT key_value FROM bulk_keys)",
+                                (package,))
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+
+    run_write(write)
+    deleted = [k for k in keys if k in found]
+    not_found = [k for k in keys if k not in found]
+    # (the key filter keeps deleted keys as "maybe present"; sqlite answers for them)
+    invalidate_keys(package, deleted)
+    token_revocations.revoke(package, deleted)
+
+    if _wants_diff(data):
+        mark_snapshot_dirty()
+        return jsonify({
+            "success": True,
+            "deleted": deleted,
+            "not_found": not_found,
+            "counts": {"deleted": len(deleted), "not_found": len(not_found)},
+        }), 200
 
     update_snapshot_from_sqlite()
     return force_download(DB_JSON_FILE, "keys_db.json")
@@ -322,17 +2297,21 @@ def add_key():
     if not key:
         return jsonify({"error": "key is required"}), 400
 
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
+    def write():
+        con = get_db(shard_for(package, key))
+        cur = con.cursor()
 
-    if not package:
-        cur.execute("INSERT OR IGNORE INTO simple_keys(key_value,is_used,device_id,last_verified) VALUES(?,0,NULL,NULL)", (key,))
-    else:
-        cur.execute("INSERT OR IGNORE INTO secure_keys(package,key_value,is_used,device_id,last_verified) VALUES(?,?,?,?,?)",
-                    (package, key, 0, None, None))
+        if not package:
+            cur.execute("INSERT OR IGNORE INTO simple_keys(key_value,is_used,device_id,last_verified) VALUES(?,0,NULL,NULL)", (key,))
+        else:
+            cur.execute("INSERT OR IGNORE INTO secure_keys(package,key_value,is_used,device_id,last_verified) VALUES(?,?,?,?,?)",
+                        (package, key, 0, None, None))
 
-    con.commit()
-    con.close()
+        con.commit()
+
+    run_write(write)
+    key_filter.add(package, [key])
+    invalidate_keys(package, [key])
 
     update_snapshot_from_sqlite()
     return force_download(DB_JSON_FILE, "keys_db.json")
@@ -354,32 +2333,25 @@ def delete_key():
     if not key:
         return jsonify({"error": "key is required"}), 400
 
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
-
-    if not package:
-        cur.execute("SELECT 1 FROM simple_keys WHERE key_value=?", (key,))
-        if cur.fetchone():
-            cur.execute("DELETE FROM simple_keys WHERE key_value=?", (key,))
-            con.commit()
-            con.close()
-            update_snapshot_from_sqlite()
-            return force_download(DB_JSON_FILE, "keys_db.json")
+    def write():
+        # True when the key existed and is gone now
+        con = get_db(shard_for(package, key))
+        if not package:
+            deleted = con.execute("DELETE FROM simple_keys WHERE key_value=?", (key,)).rowcount
         else:
-            con.close()
-            return jsonify({"error": "Key not found in SIMPLE_KEYS"}), 404
-    else:
-        cur.execute("SELECT 1 FROM secure_keys WHERE package=? AND key_value=?", (package, key))
-        if cur.fetchone():
-            cur.execute("DELETE FROM secure_keys WHERE package=? AND key_value=?", (package, key))
             # remove package if empty (no extra action needed)
-            con.commit()
-            con.close()
-            update_snapshot_from_sqlite()
-            return force_download(DB_JSON_FILE, "keys_db.json")
-        else:
-            con.close()
-            return jsonify({"error": "Key not found in SECURE_KEYS for this package"}), 404
+            deleted = con.execute("DELETE FROM secure_keys WHERE package=? AND key_value=?", (package, key)).rowcount
+        con.commit()
+        return deleted > 0
+
+    if not run_write(write):
+        if not package:
+            return jsonify({"error": "Key not found in SIMPLE_KEYS"}), 404
+        return jsonify({"error": "Key not found in SECURE_KEYS for this package"}), 404
+    invalidate_keys(package, [key])
+    token_revocations.revoke(package, [key])
+    update_snapshot_from_sqlite()
+    return force_download(DB_JSON_FILE, "keys_db.json")
 
 
 # ----------------- API: keys verification (GET) -----------------
@@ -391,46 +2363,103 @@ def handle_keys():
     sig = request.args.get("sig")
 
     if not key or not device_id:
+        note_outcome("bad_request")
         return jsonify({"error": "Missing key or device_id"}), 400
 
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
-
     is_secure = bool(package and sig)
 
-    if is_secure:
-        if not verify_signature(sig):
-            con.close()
-            return jsonify({"error": "SIGNATURE VERIFICATION FAILED"}), 403
-        cur.execute("SELECT is_used,device_id FROM secure_keys WHERE package=? AND key_value=?", (package, key))
-    else:
-        cur.execute("SELECT is_used,device_id FROM simple_keys WHERE key_value=?", (key,))
-
-    row = cur.fetchone()
-    if not row:
-        con.close()
-        return jsonify({"error": "Invalid key or package (secure mode)" if is_secure else "Invalid simple key"}), 401
-
-    entry_is_used, entry_device = row
-
-    if entry_is_used and entry_device != device_id:
-        con.close()
-        return jsonify({"error": "Key already in use by another device"}), 403
+    if is_secure and not verify_signature(sig):
+        note_outcome("bad_signature")
+        return jsonify({"error": "SIGNATURE VERIFICATION FAILED"}), 403
 
     # register/verify (preserve original behavior)
     now = time.time()
-    if is_secure:
-        cur.execute("UPDATE secure_keys SET is_used=1,device_id=?,last_verified=? WHERE package=? AND key_value=?",
-                    (device_id, now, package, key))
-    else:
-        cur.execute("UPDATE simple_keys SET is_used=1,device_id=?,last_verified=? WHERE key_value=?",
-                    (device_id, now, key))
+    outcome = verify_key_binding(package if is_secure else None, key, device_id)
+    body, status = _keys_result(outcome, is_secure)
+    if outcome == VERIFY_OK:
+        if VERIFY_TOKEN_TTL_SECONDS > 0:
+            body["token"] = issue_verify_token(package if is_secure else None, key, device_id, now)
+            body["token_expires_in"] = VERIFY_TOKEN_TTL_SECONDS
+    return jsonify(body), status
 
-    con.commit()
-    con.close()
 
-    update_snapshot_from_sqlite()
-    return jsonify({"success": True, "message": "Key verified/registered"}), 200
+# ----------------- API: batch keys verification (POST) -----------------
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "1000"))
+
+
+@app.route("/keys_batch", methods=["POST"])
+def handle_keys_batch():
+    # body: {"items": [{"key", "device_id", "package", "sig"}, ...]} (or the bare list);
+    # every item follows the /keys rules and all of them commit in one transaction
+    # (one per shard when sharded)
+    data = request.get_json(force=True, silent=True)
+    items = data.get("items") if isinstance(data, dict) else data
+    if not items or not isinstance(items, list):
+        return jsonify({"error": "Provide 'items' as a non-empty list"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"At most {BATCH_MAX_ITEMS} items per batch"}), 400
+
+    sig_ok = {}     # each distinct sig is checked once for the whole batch
+    results = []
+    pending = []    # (index in results, package or None, key, device_id, is_secure)
+    for item in items:
+        if not isinstance(item, dict):
+            note_outcome("bad_request")
+            results.append({"status": 400, "error": "Invalid item"})
+            continue
+        key = item.get("key")
+        device_id = item.get("device_id")
+        package = item.get("package")
+        sig = item.get("sig")
+        if not isinstance(key, str) or not isinstance(device_id, str) or not key or not device_id:
+            note_outcome("bad_request")
+            results.append({"key": key, "device_id": device_id, "status": 400,
+                            "error": "Missing key or device_id"})
+            continue
+        if not isinstance(package, (str, type(None))) or not isinstance(sig, (str, type(None))):
+            note_outcome("bad_request")
+            results.append({"key": key, "device_id": device_id, "status": 400,
+                            "error": "package and sig must be strings"})
+            continue
+
+        is_secure = bool(package and sig)
+        if is_secure:
+            if sig not in sig_ok:
+                sig_ok[sig] = verify_signature(sig)
+            if not sig_ok[sig]:
+                note_outcome("bad_signature")
+                results.append({"key": key, "device_id": device_id, "status": 403,
+                                "error": "SIGNATURE VERIFICATION FAILED"})
+                continue
+        pending.append((len(results), package if is_secure else None, key, device_id, is_secure))
+        results.append(None)
+
+    def write():
+        verified = []
+        try:
+            for _, package, key, device_id, _ in pending:
+                verified.append(_verify_key_binding(package, key, device_id, False))
+            for con in _open_dbs():
+                con.commit()
+        except Exception:
+            for con in _open_dbs():
+                con.rollback()
+            # bindings cached during the failed batch were never committed
+            key_cache.clear()
+            raise
+        return verified
+
+    wrote_any = False
+    for (i, _, key, device_id, is_secure), (outcome, wrote) in zip(pending, run_write(write) if pending else []):
+        note_outcome(outcome)
+        wrote_any = wrote_any or wrote
+        body, status = _keys_result(outcome, is_secure)
+        body.update({"key": key, "device_id": device_id, "status": status})
+        results[i] = body
+
+    if wrote_any:
+        mark_snapshot_dirty()
+    return jsonify({"results": results}), 200
 
 
 # ----------------- API: ids (POST) for device registration -----------------
@@ -446,42 +2475,50 @@ def handle_ids():
         device_id = None
 
     if not key or not device_id:
+        note_outcome("bad_request")
         return jsonify({"error": "Missing key or device_id"}), 400
 
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
     is_secure = bool(package and sig)
 
-    if is_secure:
-        if not verify_signature(sig):
-            con.close()
-            return jsonify({"error": "SIGNATURE VERIFICATION FAILED"}), 403
-        cur.execute("SELECT is_used,device_id FROM secure_keys WHERE package=? AND key_value=?", (package, key))
-    else:
-        cur.execute("SELECT is_used,device_id FROM simple_keys WHERE key_value=?", (key,))
+    if is_secure and not verify_signature(sig):
+        note_outcome("bad_signature")
+        return jsonify({"error": "SIGNATURE VERIFICATION FAILED"}), 403
 
-    row = cur.fetchone()
-    if not row:
-        con.close()
+    now = time.time()
+    outcome = verify_key_binding(package if is_secure else None, key, device_id)
+    if outcome == VERIFY_UNKNOWN:
         return jsonify({"error": "Invalid key/package (secure mode)" if is_secure else "Invalid simple key"}), 401
-
-    entry_is_used, entry_device = row
-    if entry_is_used and entry_device != device_id:
-        con.close()
+    if outcome == VERIFY_CONFLICT:
         return jsonify({"error": "Key already registered to another device"}), 403
 
-    now = time.time()
-    if is_secure:
-        cur.execute("UPDATE secure_keys SET is_used=1,device_id=?,last_verified=? WHERE package=? AND key_value=?",
-                    (device_id, now, package, key))
-    else:
-        cur.execute("UPDATE simple_keys SET is_used=1,device_id=?,last_verified=? WHERE key_value=?",
-                    (device_id, now, key))
+    body = {"success": True, "message": "Device registered/verified"}
+    if VERIFY_TOKEN_TTL_SECONDS > 0:
+        body["token"] = issue_verify_token(package if is_secure else None, key, device_id, now)
+        body["token_expires_in"] = VERIFY_TOKEN_TTL_SECONDS
+    return jsonify(body), 200
 
-    con.commit()
-    con.close()
-    update_snapshot_from_sqlite()
-    return jsonify({"success": True, "message": "Device registered/verified"}), 200
+
+# ----------------- API: token re-check (no database) -----------------
+@app.route("/verify_token", methods=["GET"])
+def verify_token():
+    # same key/device_id/package as the /keys or /ids call that issued the token;
+    # no sig needed: the token already proves a signed check passed
+    key = request.args.get("key")
+    device_id = request.args.get("device_id")
+    package = request.args.get("package") or None
+    token = request.args.get("token")
+
+    if VERIFY_TOKEN_TTL_SECONDS <= 0:
+        return jsonify({"error": "Verification tokens are disabled"}), 404
+    if not key or not device_id or not token:
+        note_outcome("bad_request")
+        return jsonify({"error": "Missing key, device_id or token"}), 400
+
+    error = check_verify_token(token, package, key, device_id)
+    note_outcome("token_ok" if error is None else "token_rejected")
+    if error:
+        return jsonify({"error": error}), 401
+    return jsonify({"success": True, "message": "Token valid"}), 200
 
 
 # ----------------- API: download DB manually (preserve original behavior) -----------------
@@ -489,11 +2526,9 @@ def handle_ids():
 def download_db():
     if request.headers.get("X-PASS") != PASS_DOWNLOAD:
         return jsonify({"error": "Invalid password"}), 403
-    # ensure snapshot up-to-date
-    update_snapshot_from_sqlite()
-    if not os.path.exists(DB_JSON_FILE):
-        write_json_snapshot(DEFAULT_DB)
-    return force_download(DB_JSON_FILE, "keys_db.json")
+    # streamed straight from sqlite (same bytes as keys_db.json), so it is
+    # always current without first rewriting the snapshot file
+    return stream_db_response(indent=4, sort_keys=False, filename="keys_db.json")
 
 
 # ----------------- API: upload DB (restore after redeploy) -----------------
@@ -505,47 +2540,428 @@ def upload_db():
     if "file" not in request.files:
         return jsonify({"error": "File missing"}), 400
     file = request.files["file"]
-    # save JSON snapshot
-    file.save(DB_JSON_FILE)
+    # save next to the live snapshot; it only replaces keys_db.json once the
+    # restore succeeded, so a malformed upload never clobbers the current file
+    target_dir = os.path.dirname(os.path.abspath(DB_JSON_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload.", suffix=".json", dir=target_dir)
+    os.close(fd)
+    try:
+        file.save(tmp_path)
+        init_sqlite()
+        try:
+            restore_from_json_upload(tmp_path)
+        except ValueError:
+            return jsonify({"error": "Uploaded file is not valid JSON"}), 400
+        invalidate_all_keys()
+
+        # keep the uploaded JSON as the snapshot (preserve original JSON content)
+        with _snapshot_lock, _snapshot_file_lock():
+            counter = total_change_counter(all_dbs())
+            os.chmod(tmp_path, _snapshot_mode())
+            os.replace(tmp_path, DB_JSON_FILE)
+            record_snapshot(counter)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return jsonify({"success": True, "message": "Database restored successfully"}), 200
 
-    # reload sqlite from JSON snapshot (preserve original JSON content)
+
+# ----------------- API: binary backup (sqlite online backup) -----------------
+@app.route("/backup_db", methods=["GET"])
+def backup_db():
+    # ?compress=1 gzips the stream; the JSON /download_db stays as it was
+    if request.headers.get("X-PASS") != PASS_DOWNLOAD:
+        return jsonify({"error": "Invalid password"}), 403
+    compress = request.args.get("compress", "").lower() in ("1", "true", "gzip")
+    flush_heartbeats()
+    path = _scratch_file(".backup.")
     try:
-        with open(DB_JSON_FILE, "r") as f:
-            j = json.load(f)
+        counter, seq = write_backup(path)
     except Exception:
-        return jsonify({"error": "Uploaded file is not valid JSON"}), 400
+        os.remove(path)
+        raise
+    route = request.url_rule.rule
 
-    # wipe sqlite and load new
-    init_sqlite()
-    con = sqlite3.connect(DB_SQLITE_FILE)
-    cur = con.cursor()
-    cur.execute("DELETE FROM simple_keys")
-    cur.execute("DELETE FROM secure_keys")
-    con.commit()
+    def generate():
+        t0 = time.perf_counter()
+        try:
+            z = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                    data = z.compress(chunk) if z else chunk
+                    if data:
+                        yield data
+            if z:
+                yield z.flush()
+        finally:
+            os.remove(path)
+            metrics.observe_stage(route, "serialize", time.perf_counter() - t0)
+
+    name = "keys.db" if SQLITE_SHARDS == 1 else "keys-shards.tar"
+    if compress:
+        name += ".gz"
+    resp = Response(generate(), mimetype="application/octet-stream")
+    resp.headers.set("Content-Disposition", f"attachment; filename={name}")
+    if not compress:
+        resp.headers.set("Content-Length", os.path.getsize(path))
+    resp.headers.set("X-Change-Counter", str(counter))
+    resp.headers.set("X-Change-Seq", str(seq))
+    return resp
 
-    # load contents
-    for k, v in j.get("SIMPLE_KEYS", {}).items():
-        cur.execute("INSERT OR REPLACE INTO simple_keys(key_value,is_used,device_id,last_verified) VALUES(?,?,?,?)",
-                    (k, int(v.get("is_used", False)), v.get("device_id"), v.get("last_verified")))
-    for pkg, keys in j.get("SECURE_KEYS", {}).items():
-        for k, v in keys.items():
-            cur.execute("INSERT OR REPLACE INTO secure_keys(package,key_value,is_used,device_id,last_verified) VALUES(?,?,?,?,?)",
-                        (pkg, k, int(v.get("is_used", False)), v.get("device_id"), v.get("last_verified")))
-    con.commit()
-    con.close()
 
-    return jsonify({"success": True, "message": "Database restored successfully"}), 200
+# ----------------- API: restore a binary backup -----------------
+@app.route("/restore_db", methods=["POST"])
+def restore_db():
+    if request.headers.get("X-PASS") != PASS_UPLOAD:
+        return jsonify({"error": "Invalid password"}), 403
+    if "file" not in request.files:
+        return jsonify({"error": "File missing"}), 400
+
+    scratch = [_scratch_file(".restore.")]
+    try:
+        request.files["file"].save(scratch[0])
+        try:
+            # every file is checked before anything is staged or swapped in
+            paths = unpack_backup(scratch[0], scratch)
+            for path in paths:
+                check_backup_file(path)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid backup: {e}"}), 400
+        init_sqlite()
+        counts = restore_via_staging(lambda con: stage_sqlite_backup(con, paths))
+        invalidate_all_keys()
+    finally:
+        for path in scratch:
+            for p in (path, path + "-journal"):
+                if os.path.exists(p):
+                    os.remove(p)
+    # keys_db.json follows in the background (the JSON rewrite is the slow part)
+    mark_snapshot_dirty()
+    return jsonify({"success": True, "message": "Database restored successfully", "counts": counts}), 200
 
 
 # ----------------- API: list all (debug) -----------------
 @app.route("/list_all", methods=["GET"])
 def list_all():
     # Password check
-    if request.headers.get("X-PASS") != "Xksps":
+    if request.headers.get("X-PASS") != PASS_LIST:
         return jsonify({"error": "Invalid password"}), 403
 
-    j = sqlite_to_json()
-    return jsonify(j), 200
+    return stream_db_response(indent=None, sort_keys=True)
+
+
+# ----------------- API: paginated listing (admin UI) -----------------
+LIST_PAGE_DEFAULT = 100
+LIST_PAGE_MAX = 1000
+
+
+def _encode_list_cursor(order, values):
+    raw = json.dumps({"o": order, "k": list(values)}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_list_cursor(cursor, order, n):
+    try:
+        obj = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        values = obj["k"]
+    except Exception:
+        raise ValueError("invalid cursor")
+    if obj.get("o") != order or not isinstance(values, list) or len(values) != n:
+        raise ValueError("cursor does not match this query")
+    return values
+
+
+def _parse_bool(value):
+    v = value.strip().lower()
+    if v in ("1", "true", "yes"):
+        return 1
+    if v in ("0", "false", "no"):
+        return 0
+    raise ValueError("is_used must be true/false")
+
+
+@app.route("/list_keys", methods=["GET"])
+def list_keys():
+    """
+    One page of a table, in key order (or last_verified order when a
+    verified_after/verified_before range is given; that range only matches
+    bound keys). Each page is an index range scan of limit rows per shard,
+    resumed from the opaque next_cursor, so its cost doesn't grow with the DB.
+    """
+    if request.headers.get("X-PASS") != PASS_LIST:
+        return jsonify({"error": "Invalid password"}), 403
+
+    args = request.args
+    table = args.get("table", "").upper()
+    if table not in ("SECURE_KEYS", "SIMPLE_KEYS"):
+        return jsonify({"error": "table must be SECURE_KEYS or SIMPLE_KEYS"}), 400
+    secure = table == "SECURE_KEYS"
+    package = args.get("package")
+    if package and not secure:
+        return jsonify({"error": "package only applies to SECURE_KEYS"}), 400
+
+    where, params = [], []
+    try:
+        limit = min(max(int(args.get("limit", LIST_PAGE_DEFAULT)), 1), LIST_PAGE_MAX)
+        if package:
+            where.append("package=?")
+            params.append(package)
+        if args.get("is_used") is not None:
+            where.append("is_used=?")
+            params.append(_parse_bool(args["is_used"]))
+        if args.get("device_id"):
+            where.append("device_id=?")
+            params.append(args["device_id"])
+        after, before = args.get("verified_after"), args.get("verified_before")
+        by_time = after is not None or before is not None
+        if by_time:
+            where.append("is_used=1")    # matches the partial last_verified index
+            if after is not None:
+                where.append("last_verified>=?")
+                params.append(float(after))
+            if before is not None:
+                where.append("last_verified<?")
+                params.append(float(before))
+
+        # with a package filter the package is fixed, so key_value alone resumes the scan
+        key_cols = ["package", "key_value"] if secure and not package else ["key_value"]
+        order_cols = (["last_verified"] if by_time else []) + key_cols
+        order = "time" if by_time else "key"
+        if args.get("cursor"):
+            values = _decode_list_cursor(args["cursor"], order, len(order_cols))
+            where.append(f"({','.join(order_cols)})>({','.join('?' * len(order_cols))})")
+            params.extend(values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # a time range walks the partial last_verified index (the planner would
+    # otherwise pick the is_used index and sort every match)
+    hint = f" INDEXED BY {table.lower()}_last_verified" if by_time and not args.get("device_id") else ""
+    sql = (f"SELECT {'package' if secure else 'NULL'},key_value,is_used,device_id,last_verified "
+           f"FROM {table.lower()}{hint}"
+           + (" WHERE " + " AND ".join(where) if where else "")
+           + f" ORDER BY {','.join(order_cols)} LIMIT ?")
+
+    def sort_key(r):
+        return ((r[4],) if by_time else ()) + ((r[0], r[1]) if secure and not package else (r[1],))
+
+    cons = [get_db(shard_for(package, None))] if package else all_dbs()
+    rows = list(merged_rows(cons, sql, sort_key, params + [limit + 1]))[:limit + 1]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = []
+    for pkg, k, is_used, device_id, last_verified in rows:
+        item = {"key": k, "is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
+        if secure:
+            item["package"] = pkg
+        items.append(item)
+    return jsonify({
+        "table": table,
+        "items": items,
+        "has_more": has_more,
+        "next_cursor": _encode_list_cursor(order, sort_key(rows[-1])) if has_more else None,
+    }), 200
+
+
+# ----------------- API: per-package used/free summary -----------------
+@app.route("/keys_summary", methods=["GET"])
+def keys_summary():
+    if request.headers.get("X-PASS") != PASS_LIST:
+        return jsonify({"error": "Invalid password"}), 403
+    # covering index scans (primary key and *_used indexes), summed over shards
+    packages = {}
+    simple_total = simple_used = 0
+    for con in all_dbs():
+        for pkg, n in con.execute("SELECT package,COUNT(*) FROM secure_keys GROUP BY package"):
+            packages.setdefault(pkg, [0, 0])[0] += n
+        for pkg, n in con.execute("SELECT package,COUNT(*) FROM secure_keys WHERE is_used=1 GROUP BY package"):
+            packages.setdefault(pkg, [0, 0])[1] += n
+        simple_total += con.execute("SELECT COUNT(*) FROM simple_keys").fetchone()[0]
+        simple_used += con.execute("SELECT COUNT(*) FROM simple_keys WHERE is_used=1").fetchone()[0]
+    return jsonify({
+        "SECURE_KEYS": {pkg: {"total": t, "used": u, "free": t - u} for pkg, (t, u) in sorted(packages.items())},
+        "SIMPLE_KEYS": {"total": simple_total, "used": simple_used, "free": simple_total - simple_used},
+    }), 200
+
+
+# ----------------- API: key cache stats (sizing) -----------------
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    if request.headers.get("X-PASS") != PASS_DOWNLOAD:
+        return jsonify({"error": "Invalid password"}), 403
+    return jsonify(key_cache.stats()), 200
+
+
+# ----------------- API: key filter stats (false-positive rate / memory) -----------------
+@app.route("/filter_stats", methods=["GET"])
+def filter_stats():
+    if request.headers.get("X-PASS") != PASS_DOWNLOAD:
+        return jsonify({"error": "Invalid password"}), 403
+    return jsonify(key_filter.stats()), 200
+
+
+# ----------------- API: keys held by a device (indexed lookup) -----------------
+@app.route("/device_keys", methods=["GET"])
+def device_keys():
+    if request.headers.get("X-PASS") != PASS_DOWNLOAD:
+        return jsonify({"error": "Invalid password"}), 403
+    device_id = request.args.get("device_id")
+    if not device_id:
+        return jsonify({"error": "device_id is required"}), 400
+
+    out = {"device_id": device_id, "SECURE_KEYS": {}, "SIMPLE_KEYS": {}}
+    for con in all_dbs():
+        for pkg, k, is_used, last_verified in con.execute(
+                "SELECT package,key_value,is_used,last_verified FROM secure_keys WHERE device_id=?", (device_id,)):
+            out["SECURE_KEYS"].setdefault(pkg, {})[k] = {
+                "is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
+        for k, is_used, last_verified in con.execute(
+                "SELECT key_value,is_used,last_verified FROM simple_keys WHERE device_id=?", (device_id,)):
+            out["SIMPLE_KEYS"][k] = {"is_used": bool(is_used), "device_id": device_id, "last_verified": last_verified}
+    return jsonify(out), 200
+
+
+# ----------------- API: release stale bindings on demand -----------------
+@app.route("/sweep_stale", methods=["POST"])
+def sweep_stale():
+    # body: {"older_than": seconds} (defaults to BINDING_TTL_SECONDS)
+    if request.headers.get("X-PASS") != PASS_DELETE:
+        return jsonify({"error": "Invalid password"}), 403
+    data = request.get_json(force=True, silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Body must be a JSON object"}), 400
+    try:
+        older_than = float(data.get("older_than", BINDING_TTL_SECONDS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "older_than must be a number"}), 400
+    if older_than <= 0:
+        return jsonify({"error": "older_than must be positive (no BINDING_TTL_SECONDS configured)"}), 400
+    released = release_stale_bindings(older_than)
+    return jsonify({"success": True, "released": released, "older_than": older_than}), 200
+
+
+# ----------------- API: change log (delta sync) -----------------
+CHANGES_PAGE_LIMIT = 5000
+# default age for /changes/compact when the request gives no bound (7 days)
+CHANGELOG_RETENTION_SECONDS = float(os.environ.get("CHANGELOG_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+
+@app.route("/changes", methods=["GET"])
+def changes():
+    if request.headers.get("X-PASS") != PASS_DOWNLOAD:
+        return jsonify({"error": "Invalid password"}), 403
+    # since/last_seq are change cursors: a plain seq, or "seq0.seq1..." when sharded
+    try:
+        since = parse_change_cursor(request.args.get("since", "0"))
+        limit = max(1, min(int(request.args.get("limit", str(CHANGES_PAGE_LIMIT))), CHANGES_PAGE_LIMIT))
+    except ValueError:
+        return jsonify({"error": "since must be a change cursor and limit an integer"}), 400
+
+    # floor and rows from one read transaction per shard, so a compaction or a
+    # commit in between can't open a gap the caller never hears about
+    cons = all_dbs()
+    try:
+        for con in cons:
+            con.execute("BEGIN")
+        floors = [con.execute("SELECT value FROM db_meta WHERE name='changelog_floor'").fetchone()[0]
+                  for con in cons]
+        if any(s < f for s, f in zip(since, floors)):
+            # entries the caller needs were compacted away: full download required
+            return jsonify({"error": "Changes before this sequence were compacted",
+                            "reset_required": True, "min_seq": format_change_cursor(floors)}), 410
+
+        # each shard's log is read in seq order; shards are interleaved by time
+        per_shard = [[(shard,) + r for r in con.execute(
+                         "SELECT seq,ts,op,package,key_value,is_used,device_id FROM change_log "
+                         "WHERE seq>? ORDER BY seq LIMIT ?", (since[shard], limit + 1))]
+                     for shard, con in enumerate(cons)]
+    finally:
+        for con in cons:
+            con.rollback()
+    rows = list(heapq.merge(*per_shard, key=lambda r: r[2])) if len(cons) > 1 else per_shard[0]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    out = []
+    last = list(since)
+    for shard, seq, ts, op, pkg, k, is_used, device_id in rows:
+        entry = {
+            "seq": seq,
+            "ts": ts,
+            "op": op,
+            "table": None if op == "reset" else ("SECURE_KEYS" if pkg is not None else "SIMPLE_KEYS"),
+            "package": pkg,
+            "key": k,
+            "is_used": None if is_used is None else bool(is_used),
+            "device_id": device_id,
+        }
+        if SQLITE_SHARDS > 1:
+            entry["shard"] = shard
+        out.append(entry)
+        last[shard] = seq
+    # (a shard with nothing pending keeps the caller's cursor)
+    last_seq = format_change_cursor(last)
+    return jsonify({
+        "changes": out,
+        "last_seq": last_seq,
+        "has_more": has_more,
+        "reset_required": any(c["op"] == "reset" for c in out),
+    }), 200
+
+
+def compact_change_log(before_seq=None, older_than=None):
+    """
+    Delete log entries up to before_seq (per-shard seqs, see parse_change_cursor)
+    and/or older than older_than seconds. Returns (deleted, new floor cursor).
+    """
+    def write():
+        deleted = 0
+        floors = []
+        for shard, con in enumerate(all_dbs()):
+            try:
+                con.execute("BEGIN IMMEDIATE")
+                if before_seq is None:
+                    cutoff = time.time() - older_than
+                    row = con.execute("SELECT MAX(seq) FROM change_log WHERE ts<?", (cutoff,)).fetchone()
+                    upto = row[0] or 0
+                else:
+                    # never past the last seq handed out: a floor beyond it would
+                    # hide the next changes from every cursor at or below it
+                    upto = min(before_seq[shard], get_last_change_seq(con))
+                deleted += con.execute("DELETE FROM change_log WHERE seq<=?", (upto,)).rowcount
+                con.execute("UPDATE db_meta SET value=MAX(value,?) WHERE name='changelog_floor'", (upto,))
+                con.commit()
+                floors.append(con.execute("SELECT value FROM db_meta WHERE name='changelog_floor'").fetchone()[0])
+            except Exception:
+                con.rollback()
+                raise
+        return deleted, format_change_cursor(floors)
+
+    return run_write(write)
+
+
+@app.route("/changes/compact", methods=["POST"])
+def changes_compact():
+    if request.headers.get("X-PASS") != PASS_DELETE:
+        return jsonify({"error": "Invalid password"}), 403
+    data = request.get_json(force=True, silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Body must be a JSON object"}), 400
+    try:
+        before_seq = data.get("before_seq")
+        before_seq = parse_change_cursor(before_seq) if before_seq is not None else None
+        older_than = float(data.get("older_than", CHANGELOG_RETENTION_SECONDS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "before_seq must be a change cursor and older_than a number"}), 400
+
+    deleted, floor = compact_change_log(before_seq=before_seq, older_than=older_than)
+    return jsonify({"success": True, "deleted": deleted, "min_seq": floor}), 200
+
+
     # ----------------- API: debug signature (optional) -----------------
 @app.route("/debug_sig", methods=["GET"])
 def debug_sig():
@@ -561,8 +2977,303 @@ def debug_sig():
     }), 200
 
 
+# ---------------- METRICS (Prometheus text format) ----------------
+# each process keeps its own counters/histograms and dumps them to
+# METRICS_DIR/<pid>.json every METRICS_FLUSH_SECONDS; /metrics merges every
+# worker's file, so the numbers are the sum over all gunicorn workers
+METRICS_DIR = os.environ.get("METRICS_DIR", DB_SQLITE_FILE + ".metrics")
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REQUEST_STAGES = ("signature", "sqlite_query", "sqlite_commit", "snapshot_write", "serialize")
+
+
+class Metrics:
+    """Per-process counters and latency histograms, mergeable across workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}      # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                h = self.histograms[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    h[i] += 1
+                    break
+            else:
+                h[len(LATENCY_BUCKETS)] += 1
+            h[-1] += seconds
+
+    def observe_stage(self, route, stage, seconds):
+        self.observe("keyserver_stage_duration_seconds", (("route", route), ("stage", stage)), seconds)
+
+    def observe_request(self, route, status, seconds, stages, outcomes):
+        self.observe("keyserver_request_duration_seconds", (("route", route),), seconds)
+        self.inc("keyserver_requests_total", (("route", route), ("status", str(status))))
+        for stage in REQUEST_STAGES:
+            if stage in stages:
+                self.observe_stage(route, stage, stages[stage])
+        for outcome in outcomes:
+            self.inc("keyserver_verifications_total", (("route", route), ("outcome", outcome)))
+        self._ensure_flusher()
+
+    def dump(self):
+        with self._lock:
+            counters = [[n, list(map(list, l)), v] for (n, l), v in self.counters.items()]
+            histograms = [[n, list(map(list, l)), list(h)] for (n, l), h in self.histograms.items()]
+        # process-local components, exported as counters
+        for name, value in (("keyserver_key_cache_hits_total", key_cache.hits),
+                            ("keyserver_key_cache_misses_total", key_cache.misses),
+                            ("keyserver_key_filter_rejected_total", key_filter.rejected),
+                            ("keyserver_log_records_dropped_total", log_handler.dropped)):
+            counters.append([name, [], value])
+        return {"counters": counters, "histograms": histograms}
+
+    def flush(self):
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.dump(), f)
+            os.replace(tmp, path)
+        except Exception:
+            logging.exception("Failed to write metrics file")
+
+    def _flusher_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            self.flush()
+
+    def _ensure_flusher(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._flusher_loop, name="metrics-flusher", daemon=True)
+                self._thread.start()
+
+    def collect(self):
+        """Sum this process's live values with every other worker's last dump."""
+        dumps = [self.dump()]
+        own = f"{os.getpid()}.json"
+        with _metrics_file_lock(shared=True):
+            try:
+                names = [n for n in os.listdir(METRICS_DIR) if n.endswith(".json") and n != own]
+            except OSError:
+                names = []
+            for n in names:
+                try:
+                    with open(os.path.join(METRICS_DIR, n)) as f:
+                        dumps.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        counters, histograms = {}, {}
+        for d in dumps:
+            for name, labels, value in d.get("counters", []):
+                k = (name, tuple(map(tuple, labels)))
+                counters[k] = counters.get(k, 0) + value
+            for name, labels, h in d.get("histograms", []):
+                k = (name, tuple(map(tuple, labels)))
+                acc = histograms.setdefault(k, [0] * len(h))
+                for i, v in enumerate(h):
+                    acc[i] += v
+        return counters, histograms
+
+
+metrics = Metrics()
+atexit.register(metrics.flush)
+
+
+METRICS_AGGREGATE = "aggregate.json"
+METRICS_LOCK_FILE = METRICS_DIR + ".lock"
+
+
+@contextlib.contextmanager
+def _metrics_file_lock(shared=False):
+    # shared for readers of METRICS_DIR, exclusive while folding a dead worker
+    # into the aggregate, so /metrics never sees a worker counted twice or not at all
+    with open(METRICS_LOCK_FILE, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+def _merge_dump(acc, d):
+    counters = {(n, json.dumps(l)): v for n, l, v in acc.get("counters", [])}
+    histograms = {(n, json.dumps(l)): h for n, l, h in acc.get("histograms", [])}
+    for name, labels, value in d.get("counters", []):
+        k = (name, json.dumps(labels))
+        counters[k] = counters.get(k, 0) + value
+    for name, labels, h in d.get("histograms", []):
+        k = (name, json.dumps(labels))
+        a = histograms.setdefault(k, [0] * len(h))
+        for i, v in enumerate(h):
+            a[i] += v
+    return {"counters": [[n, json.loads(l), v] for (n, l), v in counters.items()],
+            "histograms": [[n, json.loads(l), h] for (n, l), h in histograms.items()]}
+
+
+def prune_dead_worker_metrics():
+    # files of workers that no longer exist (previous runs) would otherwise pile
+    # up. Their counters and histograms are folded into METRICS_AGGREGATE before
+    # the file goes, so the summed *_total / _bucket series never go backwards
+    # (which Prometheus would read as a counter reset).
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return
+    dead = []
+    for n in names:
+        pid = n.split(".")[0]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            dead.append(n)
+        except OSError:
+            pass
+    if not dead:
+        return
+    agg_path = os.path.join(METRICS_DIR, METRICS_AGGREGATE)
+    with _metrics_file_lock():
+        try:
+            with open(agg_path) as f:
+                agg = json.load(f)
+        except (OSError, ValueError):
+            agg = {}
+        merged = []
+        for n in dead:
+            path = os.path.join(METRICS_DIR, n)
+            if n.endswith(".json"):
+                try:
+                    with open(path) as f:
+                        agg = _merge_dump(agg, json.load(f))
+                except FileNotFoundError:
+                    continue
+                except (OSError, ValueError):
+                    pass
+            merged.append(path)
+        try:
+            tmp = agg_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(agg, f)
+            os.replace(tmp, agg_path)
+        except OSError:
+            logging.exception("Failed to write metrics aggregate")
+            return
+        for path in merged:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _prom_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    esc = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in items]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in esc) + "}"
+
+
+def render_prometheus(counters, histograms, gauges):
+    lines = []
+    typed = set()
+
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        type_line(name, "counter")
+        lines.append(f"{name}{_prom_labels(labels)} {value}")
+    for (name, labels), h in sorted(histograms.items()):
+        type_line(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, h):
+            cumulative += n
+            lines.append(f"{name}_bucket{_prom_labels(labels, [('le', repr(bound))])} {cumulative}")
+        cumulative += h[len(LATENCY_BUCKETS)]
+        lines.append(f"{name}_bucket{_prom_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{name}_sum{_prom_labels(labels)} {h[-1]}")
+        lines.append(f"{name}_count{_prom_labels(labels)} {cumulative}")
+    for name, labels, value in gauges:
+        type_line(name, "gauge")
+        lines.append(f"{name}{_prom_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _table_gauges():
+    cons = all_dbs()
+    gauges = []
+    for table, label in (("secure_keys", "SECURE_KEYS"), ("simple_keys", "SIMPLE_KEYS")):
+        total = used = 0
+        for con in cons:
+            t, u = con.execute(f"SELECT COUNT(*), COALESCE(SUM(is_used),0) FROM {table}").fetchone()
+            total += t
+            used += u
+        gauges.append(("keyserver_keys", (("table", label), ("state", "used")), used))
+        gauges.append(("keyserver_keys", (("table", label), ("state", "free")), total - used))
+    gauges.append(("keyserver_change_counter", (), total_change_counter(cons)))
+    gauges.append(("keyserver_shards", (), SQLITE_SHARDS))
+    reporting = [n for n in os.listdir(METRICS_DIR) if n.split(".")[0].isdigit() and n.endswith(".json")] \
+        if os.path.isdir(METRICS_DIR) else [None]
+    gauges.append(("keyserver_workers_reporting", (), len(reporting)))
+    return gauges
+
+
+# ----------------- API: metrics (Prometheus) -----------------
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # X-PASS like every other admin route, or HTTP basic auth (any user) for scrapers
+    auth = request.authorization
+    if request.headers.get("X-PASS") != PASS_METRICS and not (auth and auth.password == PASS_METRICS):
+        return jsonify({"error": "Invalid password"}), 403
+    metrics.flush()
+    counters, histograms = metrics.collect()
+    body = render_prometheus(counters, histograms, _table_gauges())
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+# ---------------- STARTUP ----------------
+DB_LOCK_FILE = DB_SQLITE_FILE + ".lock"
+
+
+def startup():
+    # runs once per import: in the gunicorn master with --preload, otherwise in
+    # each worker. The file lock lets one process do the one-time work while the
+    # others wait, then find the DB populated and the snapshot current.
+    with open(DB_LOCK_FILE, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            sql_load_from_json_if_needed()
+            prune_dead_worker_metrics()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    # don't carry the startup connection into forked gunicorn workers
+    close_db()
+
+
+# Initialize on startup (preserve original JSON logic)
+startup()
+
+
 # ---------------- RUN APP ----------------
 if __name__ == "__main__":
-    # ensure sqlite/json initialized
-    sql_load_from_json_if_needed()
+    # sqlite/json were initialized by startup() on import
     app.run(host="0.0.0.0", port=5000, debug=False)
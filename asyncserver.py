@@ -0,0 +1,510 @@
+"""
+asyncio serving mode for the key-verification server (app.py).
+
+Serves the same Flask routes without tying a worker to every connection:
+sockets, request bodies and responses are handled on an asyncio event loop,
+so slow clients only cost a coroutine. The app itself runs on a bounded
+thread pool and only while it has work to do. Verifications and the admin
+routes' write transactions go through one dedicated writer thread. That
+thread commits concurrent /keys and /ids verifications together in one
+transaction per shard, the way /keys_batch does. An admin request only
+sends its transaction there; its snapshot rewrite and response stay on the
+pool, so verifications never queue behind them.
+
+    python asyncserver.py --host 0.0.0.0 --port 5000 --threads 8
+
+gunicorn + app:app keeps working exactly as before; this is an alternative
+entry point over the same database files. The app's tuning knobs
+(SQLITE_SHARDS, HEARTBEAT_FLUSH_INTERVAL, ...) are read from the environment
+as usual.
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import signal
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from email.utils import formatdate
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import app as keyserver
+
+ASYNC_DB_THREADS = int(os.environ.get("ASYNC_DB_THREADS", "8"))
+# requests handed to the threads at once; further ones wait on the loop
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "256"))
+ASYNC_WRITE_BATCH_MAX = int(os.environ.get("ASYNC_WRITE_BATCH_MAX", "256"))
+# how long the writer waits for more verifications before committing (0 = only
+# what queued up while the previous commit ran)
+ASYNC_WRITE_COALESCE_MS = float(os.environ.get("ASYNC_WRITE_COALESCE_MS", "0"))
+ASYNC_KEEPALIVE_TIMEOUT = float(os.environ.get("ASYNC_KEEPALIVE_TIMEOUT", "15"))
+ASYNC_IO_TIMEOUT = float(os.environ.get("ASYNC_IO_TIMEOUT", "60"))    # per read/write once a request started
+ASYNC_MAX_BODY_BYTES = int(os.environ.get("ASYNC_MAX_BODY_BYTES", str(1024 * 1024 * 1024)))
+ASYNC_SHUTDOWN_GRACE = float(os.environ.get("ASYNC_SHUTDOWN_GRACE", "10"))
+MAX_HEADER_BYTES = 64 * 1024
+BODY_SPOOL_BYTES = 1024 * 1024          # larger request bodies go to a temp file
+RESPONSE_BUFFER_CHUNKS = 16             # per streamed response, between its thread and the loop
+STREAM_CHUNK_SIZE = keyserver.STREAM_CHUNK_SIZE
+
+# framing numbers are digits only: int() would also take "+10", " 10", "1_0" or
+# "0x10", and a proxy in front reading them differently is request smuggling
+CONTENT_LENGTH_RE = re.compile(r"[0-9]+")
+CHUNK_SIZE_RE = re.compile(rb"[0-9A-Fa-f]+")
+
+REASONS = {400: "Bad Request", 408: "Request Timeout", 413: "Payload Too Large",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error",
+           501: "Not Implemented", 503: "Service Unavailable"}
+
+
+# ---------------- writer thread (coalesced verification commits) ----------------
+class DbWriter:
+    """The one thread that writes: verifications in shared transactions, other transactions one by one."""
+
+    _STOP = object()
+
+    def __init__(self, batch_max=ASYNC_WRITE_BATCH_MAX, coalesce_ms=ASYNC_WRITE_COALESCE_MS):
+        self.batch_max = max(1, batch_max)
+        self.coalesce = coalesce_ms / 1000.0
+        self.batches = 0
+        self.verifications = 0
+        self._jobs = queue.Queue()
+        self._stopping = False
+        self._submit_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        # jobs already queued still run; later ones (background flushers racing
+        # the shutdown) run on their own thread instead of waiting forever
+        with self._submit_lock:
+            self._stopping = True
+            self._jobs.put(self._STOP)
+        self._thread.join()
+
+    def _submit(self, kind, arg):
+        """Queue a job; returns its Future, or None when it must run on the calling thread."""
+        if threading.current_thread() is self._thread:
+            return None
+        fut = Future()
+        with self._submit_lock:
+            if self._stopping:
+                return None
+            self._jobs.put((kind, arg, fut))
+        return fut
+
+    def verify(self, package, key, device_id):
+        """keyserver.verify_delegate: blocks the calling pool thread until its batch committed."""
+        fut = self._submit("verify", (package, key, device_id))
+        if fut is None:
+            return keyserver._verify_key_binding(package, key, device_id, True)
+        return self._charged(fut.result())
+
+    def run(self, fn):
+        """keyserver.write_delegate: runs the transaction fn() after the writes queued before it."""
+        fut = self._submit("call", fn)
+        if fut is None:
+            return fn()
+        return self._charged(fut.result())
+
+    @staticmethod
+    def _charged(done):
+        # the request's stage metrics get the sqlite time spent for it on the writer
+        result, stages = done
+        timer = keyserver._stage_timer.__dict__
+        for stage, seconds in stages.items():
+            timer[stage] = timer.get(stage, 0.0) + seconds
+        return result
+
+    def _run(self):
+        job = None
+        while True:
+            if job is None:
+                job = self._jobs.get()
+            if job is self._STOP:
+                return
+            kind, arg, fut = job
+            job = None
+            if kind == "call":
+                timer = keyserver._stage_timer.__dict__
+                timer.clear()
+                try:
+                    fut.set_result((arg(), dict(timer)))
+                except BaseException as e:
+                    fut.set_exception(e)
+                finally:
+                    timer.clear()
+                continue
+
+            batch = [(arg, fut)]
+            deadline = time.monotonic() + self.coalesce
+            while len(batch) < self.batch_max:
+                try:
+                    wait = deadline - time.monotonic()
+                    nxt = self._jobs.get(timeout=wait) if wait > 0 else self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is self._STOP or nxt[0] != "verify":
+                    job = nxt       # handled after this batch, keeping queue order
+                    break
+                batch.append((nxt[1], nxt[2]))
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        timer = keyserver._stage_timer.__dict__
+        results = []
+        try:
+            for (package, key, device_id), _ in batch:
+                timer.clear()
+                result = keyserver._verify_key_binding(package, key, device_id, False)
+                results.append((result, dict(timer)))
+            t0 = time.perf_counter()
+            for con in keyserver._open_dbs():
+                if con.in_transaction:
+                    con.commit()
+            commit_s = time.perf_counter() - t0
+        except BaseException as e:
+            for con in keyserver._open_dbs():
+                con.rollback()
+            # bindings cached during the failed batch were never committed
+            keyserver.key_cache.clear()
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        finally:
+            timer.clear()
+        self.batches += 1
+        self.verifications += len(batch)
+        for (_, fut), (result, stages) in zip(batch, results):
+            stages["sqlite_commit"] = stages.get("sqlite_commit", 0.0) + commit_s
+            fut.set_result((result, stages))
+
+
+# ---------------- WSGI calls (run on the pool threads) ----------------
+class _ClientGone(Exception):
+    pass
+
+
+def _stream_app(environ, emit, gone):
+    """
+    Run the Flask app, passing ("start", status, headers), ("data", bytes)... to
+    emit(); the body stays on this thread since streamed responses read from
+    sqlite connections opened by the view. gone is set when the client left.
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"], started["headers"] = status, headers
+
+    body = keyserver.app(environ, start_response)
+    try:
+        emit(("start", started["status"], started["headers"]))
+        buf, size = [], 0
+        for chunk in body:
+            if gone.is_set():
+                raise _ClientGone()
+            if chunk:
+                buf.append(chunk)
+                size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                emit(("data", b"".join(buf)))
+                buf, size = [], 0
+        if buf:
+            emit(("data", b"".join(buf)))
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+# ---------------- HTTP/1.1 on asyncio streams ----------------
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Server:
+    def __init__(self, threads=ASYNC_DB_THREADS, max_inflight=ASYNC_MAX_INFLIGHT):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="db-pool")
+        self.writer = DbWriter()
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.connections = set()
+        self.server_name = "localhost"
+        self.server_port = "0"
+
+    async def start(self, host, port, reuse_port=False):
+        """Start the writer and start listening; returns the asyncio server."""
+        self.writer.start()
+        keyserver.verify_delegate = self.writer.verify
+        keyserver.write_delegate = self.writer.run
+        self.server_name, self.server_port = host, str(port)
+        return await asyncio.start_server(self._connection, host, port, limit=MAX_HEADER_BYTES,
+                                          backlog=2048, reuse_port=reuse_port or None)
+
+    async def shutdown(self, server):
+        server.close()
+        await server.wait_closed()
+        # let requests in progress finish, then drop idle keep-alive connections
+        if self.connections:
+            await asyncio.wait(self.connections, timeout=ASYNC_SHUTDOWN_GRACE)
+        for task in self.connections:
+            task.cancel()
+        self.pool.shutdown(wait=True)
+        self.writer.stop()
+        keyserver.verify_delegate = None
+        keyserver.write_delegate = None
+
+    async def serve(self, host, port, reuse_port=False):
+        server = await self.start(host, port, reuse_port)
+        logging.info("async server listening on %s:%s (%d db threads)", host, port, self.threads)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        try:
+            await stop.wait()
+        finally:
+            await self.shutdown(server)
+            logging.info("async server stopped: %d verifications in %d write batches",
+                         self.writer.verifications, self.writer.batches)
+
+    async def _connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    req = await self._read_request(reader, writer)
+                except HttpError as e:
+                    await self._send_error(writer, e.status, str(e))
+                    break
+                if req is None:
+                    break
+                keep_alive = await self._handle(req, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, _ClientGone):
+            pass
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logging.exception("async server: connection failed")
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        """Next request on the connection as (method, version, headers, environ), or None when it's done."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), ASYNC_KEEPALIVE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(431, "Request headers too large")
+
+        lines = head[:-4].decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise HttpError(400, "Malformed request line")
+        method, target, version = parts
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if not sep or not name or name != name.strip():
+                raise HttpError(400, "Malformed header")
+            name = name.lower()
+            value = value.strip()
+            headers[name] = f"{headers[name]},{value}" if name in headers else value
+
+        if headers.get("transfer-encoding", "").lower() not in ("", "identity", "chunked"):
+            raise HttpError(501, "Unsupported transfer encoding")
+        chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+        if "transfer-encoding" in headers and "content-length" in headers:
+            raise HttpError(400, "Both Transfer-Encoding and Content-Length")
+        if not CONTENT_LENGTH_RE.fullmatch(headers.get("content-length", "0")):
+            raise HttpError(400, "Invalid Content-Length")
+        length = 0 if chunked else int(headers.get("content-length", "0"))
+        if length > ASYNC_MAX_BODY_BYTES:
+            raise HttpError(413, "Request body too large")
+        if (chunked or length) and headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_BYTES)
+        if chunked:
+            length = await self._read_chunked(reader, body)
+        else:
+            remaining = length
+            while remaining:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, STREAM_CHUNK_SIZE)), ASYNC_IO_TIMEOUT)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                body.write(chunk)
+                remaining -= len(chunk)
+        body.seek(0)
+
+        path, _, query = target.partition("?")
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.server_name,
+            "SERVER_PORT": self.server_port,
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": str(peer[0]),
+            "REMOTE_PORT": str(peer[1]) if len(peer) > 1 else "",
+            "CONTENT_LENGTH": str(length) if (chunked or "content-length" in headers) else "",
+            "CONTENT_TYPE": headers.get("content-type", ""),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            if name not in ("content-type", "content-length", "transfer-encoding"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        return method, version, headers, environ
+
+    async def _read_chunked(self, reader, body):
+        total = 0
+        while True:
+            line = await asyncio.wait_for(reader.readuntil(b"\r\n"), ASYNC_IO_TIMEOUT)
+            digits = line[:-2].split(b";", 1)[0]
+            if not CHUNK_SIZE_RE.fullmatch(digits):
+                raise HttpError(400, "Malformed chunk size")
+            size = int(digits, 16)
+            if size == 0:
+                # skip trailers
+                while await asyncio.wait_for(reader.readuntil(b"\r\n"), ASYNC_IO_TIMEOUT) != b"\r\n":
+                    pass
+                return total
+            total += size
+            if total > ASYNC_MAX_BODY_BYTES:
+                raise HttpError(413, "Request body too large")
+            body.write(await asyncio.wait_for(reader.readexactly(size), ASYNC_IO_TIMEOUT))
+            if await asyncio.wait_for(reader.readexactly(2), ASYNC_IO_TIMEOUT) != b"\r\n":
+                raise HttpError(400, "Malformed chunk")
+
+    async def _handle(self, req, writer):
+        method, version, headers, environ = req
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = "close" not in connection
+        else:
+            keep_alive = "keep-alive" in connection
+        loop = asyncio.get_running_loop()
+
+        async with self.inflight:
+            chunks = asyncio.Queue(maxsize=RESPONSE_BUFFER_CHUNKS)
+            gone = threading.Event()
+
+            def emit(item):
+                if gone.is_set():
+                    raise _ClientGone()
+                asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+            work = loop.run_in_executor(self.pool, _stream_app, environ, emit, gone)
+            started = False
+            chunked = False
+            has_body = True
+            try:
+                while True:
+                    get = asyncio.ensure_future(chunks.get())
+                    await asyncio.wait((get, work), return_when=asyncio.FIRST_COMPLETED)
+                    if not get.done():
+                        get.cancel()
+                        if not chunks.empty():
+                            continue
+                        work.result()   # raises if the app failed
+                        break
+                    item = get.result()
+                    if item[0] == "start":
+                        started = True
+                        keep_alive, chunked, has_body = await self._send_head(writer, version, item[1], item[2],
+                                                                              keep_alive)
+                    elif method != "HEAD" and has_body:
+                        data = item[1]
+                        if chunked:
+                            data = b"%x\r\n%s\r\n" % (len(data), data)
+                        await self._write(writer, data)
+            except BaseException:
+                gone.set()
+                while not chunks.empty():
+                    chunks.get_nowait()
+                if not started and not work.done():
+                    await asyncio.wait((work,))
+                if not started and not work.cancelled() and work.exception() is not None \
+                        and not isinstance(work.exception(), _ClientGone):
+                    logging.error("async server: %s %s failed", method, environ["PATH_INFO"],
+                                  exc_info=work.exception())
+                    await self._send_error(writer, 500, "Internal Server Error")
+                    return False
+                raise
+            if chunked and has_body and method != "HEAD":
+                await self._write(writer, b"0\r\n\r\n")
+            return keep_alive
+
+    async def _send_head(self, writer, version, status, headers, keep_alive):
+        """Send the status line and headers; returns (keep_alive, chunked, has_body)."""
+        code = int(status.split(" ", 1)[0])
+        names = {k.lower() for k, _ in headers}
+        lines = [f"HTTP/1.1 {status}"]
+        lines += [f"{k}: {v}" for k, v in headers]
+        if "date" not in names:
+            lines.append("Date: " + formatdate(usegmt=True))
+        # 1xx/204/304 never carry a body, so they get no chunked terminator either
+        has_body = code >= 200 and code not in (204, 304)
+        chunked = False
+        if has_body and "content-length" not in names:
+            if version == "HTTP/1.1" and keep_alive:
+                lines.append("Transfer-Encoding: chunked")
+                chunked = True
+            else:
+                keep_alive = False      # body ends when the connection closes
+        if not keep_alive:
+            lines.append("Connection: close")
+        elif version != "HTTP/1.1":
+            lines.append("Connection: keep-alive")
+        await self._write(writer, ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        return keep_alive, chunked, has_body
+
+    async def _send_error(self, writer, code, message):
+        body = json.dumps({"error": message}).encode("utf-8")
+        head = (f"HTTP/1.1 {code} {REASONS.get(code, 'Error')}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                f"Date: {formatdate(usegmt=True)}\r\nConnection: close\r\n\r\n")
+        try:
+            await self._write(writer, head.encode("latin-1") + body)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+
+    async def _write(self, writer, data):
+        writer.write(data)
+        # a slow client only parks this coroutine; the timeout drops dead ones
+        await asyncio.wait_for(writer.drain(), ASYNC_IO_TIMEOUT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the key-verification app on asyncio.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=ASYNC_DB_THREADS, help="bounded pool running the app")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="SO_REUSEPORT, so several processes can share the port")
+    args = parser.parse_args(argv)
+    asyncio.run(Server(threads=args.threads).serve(args.host, args.port, args.reuse_port))
+
+
+if __name__ == "__main__":
+    main()
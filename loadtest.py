@@ -0,0 +1,546 @@
+"""
+Load/benchmark suite for the key-verification server (app.py).
+
+Seeds a fresh keys.db of N keys through the app's own schema, then drives
+/keys, /ids, /add_keys, /delete_keys, /download_db and /upload_db either
+in-process through the Flask test client or over HTTP against a local
+multi-worker gunicorn or the asyncio server (asyncserver.py). Reports
+throughput, p50/p99 latency and peak RSS and writes them as JSON so two
+commits can be compared:
+
+    python loadtest.py run --sizes 1000,100000 --modes flask,gunicorn --out before.json
+    python loadtest.py run --sizes 1000,100000 --modes flask,gunicorn --out after.json
+    python loadtest.py compare before.json after.json
+
+The app reads its tuning knobs (HEARTBEAT_FLUSH_INTERVAL, SQLITE_SHARDS, ...)
+from the environment, so export them before "run" to benchmark a config.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import signal
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SEED_PACKAGES = 10
+SEED_BOUND_FRACTION = 0.3
+SEED_BATCH = 10000
+
+
+# ---------------- seeding (runs in a child process, cwd = workdir) ----------------
+def _seed(size):
+    sys.path.insert(0, REPO_DIR)
+    import app
+
+    cons = app.all_dbs()
+    rng = random.Random(size)
+    # bulk seed with the change triggers off, like the restore path does;
+    # rows go to the shard the app routes them to (SQLITE_SHARDS)
+    for con in cons:
+        con.execute("BEGIN IMMEDIATE")
+        app.drop_change_triggers(con)
+        con.execute("DELETE FROM simple_keys")
+        con.execute("DELETE FROM secure_keys")
+    n_simple = size // 2
+    n_secure = size - n_simple
+    now = time.time()
+    simple = [[] for _ in cons]
+    secure = [[] for _ in cons]
+
+    def flush(force=False):
+        for shard, con in enumerate(cons):
+            if simple[shard] and (force or len(simple[shard]) >= SEED_BATCH):
+                con.executemany("INSERT INTO simple_keys VALUES(?,?,?,?)", simple[shard])
+                simple[shard].clear()
+            if secure[shard] and (force or len(secure[shard]) >= SEED_BATCH):
+                con.executemany("INSERT INTO secure_keys VALUES(?,?,?,?,?)", secure[shard])
+                secure[shard].clear()
+
+    for i in range(n_simple):
+        bound = rng.random() < SEED_BOUND_FRACTION
+        simple[app.shard_for(None, f"s{i}")].append(
+            (f"s{i}", int(bound), f"dev{i}" if bound else None, now if bound else None))
+        if i % SEED_BATCH == 0:
+            flush()
+    for i in range(n_secure):
+        bound = rng.random() < SEED_BOUND_FRACTION
+        pkg = f"pkg{i % SEED_PACKAGES}"
+        secure[app.shard_for(pkg, None)].append(
+            (pkg, f"k{i}", int(bound), f"dev{i}" if bound else None, now if bound else None))
+        if i % SEED_BATCH == 0:
+            flush()
+    flush(force=True)
+    for con in cons:
+        app.create_change_triggers(con)
+        con.execute("UPDATE db_meta SET value=value+1 WHERE name='change_counter'")
+        con.commit()
+    app.update_snapshot_from_sqlite()
+
+    bound_simple = [k for con in cons for (k,) in con.execute(
+        "SELECT key_value FROM simple_keys WHERE is_used=1 LIMIT 5000")]
+    bound_secure = [list(r) for con in cons for r in con.execute(
+        "SELECT package,key_value FROM secure_keys WHERE is_used=1 LIMIT 5000")]
+    return {
+        "size": size,
+        "n_simple": n_simple,
+        "n_secure": n_secure,
+        "bound_simple": bound_simple,
+        "bound_secure": bound_secure,
+        "sig": _valid_sig(app),
+        "passwords": {"add": app.PASS_ADD, "delete": app.PASS_DELETE,
+                      "download": app.PASS_DOWNLOAD, "upload": app.PASS_UPLOAD},
+    }
+
+
+def _valid_sig(app):
+    return min(app.EXPECTED_SIG_FORMS).decode("ascii")
+
+
+# ---------------- drivers ----------------
+class FlaskDriver:
+    """In-process requests through the Flask test client (one client per thread)."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._clients = {}
+
+    def request(self, method, path, headers=None, body=None):
+        tid = threading.get_ident()
+        client = self._clients.get(tid)
+        if client is None:
+            client = self._clients[tid] = self.app.test_client()
+        resp = client.open(path, method=method, headers=headers or {}, data=body)
+        resp.get_data()
+        status = resp.status_code
+        resp.close()
+        return status
+
+
+class HttpDriver:
+    """Keep-alive HTTP/1.1 requests against a running server (one connection per thread)."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._conns = {}
+
+    def request(self, method, path, headers=None, body=None):
+        tid = threading.get_ident()
+        for attempt in (1, 2):
+            conn = self._conns.get(tid)
+            if conn is None:
+                conn = self._conns[tid] = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                resp.read()
+                return resp.status
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self._conns.pop(tid, None)
+                if attempt == 2:
+                    raise
+
+
+def _multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/json\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+# ---------------- scenarios ----------------
+def _scenarios(seed, requests, heavy_requests):
+    """name -> (request count, factory(i) -> (method, path, headers, body), expected status)."""
+    pw = seed["passwords"]
+    sig = urllib.parse.quote(seed["sig"])
+    bound_simple = seed["bound_simple"] or ["s0"]
+    bound_secure = seed["bound_secure"] or [["pkg0", "k0"]]
+    run_id = uuid.uuid4().hex[:8]
+
+    def keys_repeat(i):
+        k = bound_simple[i % len(bound_simple)]
+        return "GET", f"/keys?key={k}&device_id=dev{k[1:]}", {}, None
+
+    def keys_secure(i):
+        pkg, k = bound_secure[i % len(bound_secure)]
+        return "GET", f"/keys?key={k}&package={pkg}&sig={sig}&device_id=dev{k[1:]}", {}, None
+
+    def keys_unknown(i):
+        return "GET", f"/keys?key=guess-{run_id}-{i}&device_id=x", {}, None
+
+    def ids(i):
+        pkg, k = bound_secure[i % len(bound_secure)]
+        return "POST", f"/ids?key={k}&package={pkg}&sig={sig}", {}, f"dev{k[1:]}".encode()
+
+    def add_keys(i):
+        body = json.dumps({"keys": [f"bench-{run_id}-{i}-{j}" for j in range(100)], "response": "diff"})
+        return "POST", "/add_keys", {"X-PASS": pw["add"], "Content-Type": "application/json"}, body.encode()
+
+    def delete_keys(i):
+        body = json.dumps({"keys": [f"bench-{run_id}-{i}-{j}" for j in range(100)], "response": "diff"})
+        return "POST", "/delete_keys", {"X-PASS": pw["delete"], "Content-Type": "application/json"}, body.encode()
+
+    def download_db(i):
+        return "GET", "/download_db", {"X-PASS": pw["download"]}, None
+
+    return [
+        ("keys_repeat", requests, keys_repeat, 200),
+        ("keys_secure", requests, keys_secure, 200),
+        ("keys_unknown", requests, keys_unknown, 401),
+        ("ids", requests, ids, 200),
+        ("add_keys", max(1, requests // 20), add_keys, 200),
+        ("delete_keys", max(1, requests // 20), delete_keys, 200),
+        ("download_db", heavy_requests, download_db, 200),
+    ]
+
+
+def _percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return None
+    idx = min(len(sorted_vals) - 1, max(0, int(round(pct / 100.0 * len(sorted_vals))) - 1))
+    return sorted_vals[idx]
+
+
+def _status_counts(statuses, expected):
+    # a fast 403 is not a speed-up: anything but the expected status is reported
+    seen = {}
+    for status in statuses:
+        seen[str(status)] = seen.get(str(status), 0) + 1
+    return {
+        "expected_status": expected,
+        "unexpected_status": sum(n for st, n in seen.items() if st != str(expected)),
+        "statuses": seen,
+    }
+
+
+def _run_scenario(driver, name, count, factory, concurrency, expected):
+    def one(i):
+        method, path, headers, body = factory(i)
+        t0 = time.perf_counter()
+        try:
+            status = driver.request(method, path, headers, body)
+        except Exception:
+            status = 599
+        return time.perf_counter() - t0, status
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, range(count)))
+    wall = time.perf_counter() - t0
+    lat = sorted(s[0] for s in samples)
+    errors = sum(1 for s in samples if s[1] >= 500)
+    result = {
+        "endpoint": name,
+        "requests": count,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 4),
+        "throughput_rps": round(count / wall, 2) if wall else None,
+        "p50_ms": round(_percentile(lat, 50) * 1000, 3),
+        "p99_ms": round(_percentile(lat, 99) * 1000, 3),
+        "server_errors": errors,
+    }
+    result.update(_status_counts([s[1] for s in samples], expected))
+    return result
+
+
+def _run_upload(driver, seed, heavy_requests):
+    # restore the DB from its own download: the heaviest admin path
+    pw = seed["passwords"]
+    snapshot = open("keys_db.json", "rb").read() if os.path.exists("keys_db.json") else None
+    lat, statuses, errors = [], [], 0
+    t_start = time.perf_counter()
+    for _ in range(heavy_requests):
+        if snapshot is None:
+            break
+        body, ctype = _multipart("file", "keys_db.json", snapshot)
+        t0 = time.perf_counter()
+        status = driver.request("POST", "/upload_db", {"X-PASS": pw["upload"], "Content-Type": ctype}, body)
+        lat.append(time.perf_counter() - t0)
+        statuses.append(status)
+        errors += status >= 500
+    wall = time.perf_counter() - t_start
+    lat.sort()
+    result = {
+        "endpoint": "upload_db",
+        "requests": len(lat),
+        "concurrency": 1,
+        "wall_s": round(wall, 4),
+        "throughput_rps": round(len(lat) / wall, 2) if lat and wall else None,
+        "p50_ms": round(_percentile(lat, 50) * 1000, 3) if lat else None,
+        "p99_ms": round(_percentile(lat, 99) * 1000, 3) if lat else None,
+        "server_errors": errors,
+    }
+    result.update(_status_counts(statuses, 200))
+    return result
+
+
+def _run_all(driver, seed, args):
+    results = []
+    for name, count, factory, expected in _scenarios(seed, args.requests, args.heavy_requests):
+        results.append(_run_scenario(driver, name, count, factory, args.concurrency, expected))
+    results.append(_run_upload(driver, seed, args.heavy_requests))
+    return results
+
+
+# ---------------- child entry points ----------------
+def _child_seed(workdir, size):
+    os.chdir(workdir)
+    print(json.dumps(_seed(size)))
+
+
+def _child_flask(workdir, seed_file, args):
+    os.chdir(workdir)
+    with open(seed_file) as f:
+        seed = json.load(f)
+    sys.path.insert(0, REPO_DIR)
+    import app
+    results = _run_all(FlaskDriver(app.app), seed, args)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"results": results, "peak_rss_kb": peak}))
+
+
+# ---------------- orchestration ----------------
+def _child_cmd(*extra):
+    return [sys.executable, os.path.abspath(__file__)] + [str(x) for x in extra]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start listening")
+
+
+def _proc_tree(pid):
+    # pid and all of its descendants, from the ppid field of /proc/<pid>/stat
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children.get(p, ()))
+    return tree
+
+
+def _tree_peak_rss_kb(pid):
+    """Sum of VmHWM over a server process and its workers (None without /proc)."""
+    total, seen = 0, False
+    for p in _proc_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+                        seen = True
+                        break
+        except OSError:
+            continue
+    return total if seen else None
+
+
+def _run_server(workdir, seed, args, mode):
+    port = _free_port()
+    log = open(os.path.join(workdir, f"{mode}.log"), "w")
+    if mode == "gunicorn":
+        cmd = ["gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{port}",
+               "--pythonpath", REPO_DIR, "--timeout", "300", "app:app"]
+    else:
+        cmd = [sys.executable, os.path.join(REPO_DIR, "asyncserver.py"), "--host", "127.0.0.1",
+               "--port", str(port), "--threads", str(args.threads)]
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        _wait_for_port(port, proc)
+        prev = os.getcwd()
+        os.chdir(workdir)   # _run_upload reads the seeded keys_db.json
+        try:
+            results = _run_all(HttpDriver("127.0.0.1", port), seed, args)
+        finally:
+            os.chdir(prev)
+        # sampled from the live server tree, not RUSAGE_CHILDREN: that would
+        # also count the _seed child and every earlier run, and only grows
+        peak = _tree_peak_rss_kb(proc.pid)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        log.close()
+    return results, peak
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cmd_run(args):
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    modes = [m for m in args.modes.split(",") if m]
+    out = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "requests": args.requests,
+            "heavy_requests": args.heavy_requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "threads": args.threads,
+        },
+        "results": [],
+    }
+    for size in sizes:
+        for mode in modes:
+            with tempfile.TemporaryDirectory(prefix=f"keybench-{size}-") as workdir:
+                t0 = time.time()
+                seed_out = subprocess.check_output(_child_cmd("_seed", workdir, size), cwd=workdir)
+                seed = json.loads(seed_out.decode().strip().splitlines()[-1])
+                seed_file = os.path.join(workdir, "seed.json")
+                with open(seed_file, "w") as f:
+                    json.dump(seed, f)
+                print(f"[{mode} size={size}] seeded in {time.time() - t0:.1f}s", file=sys.stderr)
+
+                if mode == "flask":
+                    raw = subprocess.check_output(
+                        _child_cmd("_flask", workdir, seed_file, "--requests", args.requests,
+                                   "--heavy-requests", args.heavy_requests, "--concurrency", args.concurrency),
+                        cwd=workdir)
+                    res = json.loads(raw.decode().strip().splitlines()[-1])
+                    results, peak = res["results"], res["peak_rss_kb"]
+                elif mode in ("gunicorn", "async"):
+                    results, peak = _run_server(workdir, seed, args, mode)
+                else:
+                    raise SystemExit(f"unknown mode: {mode}")
+
+                for r in results:
+                    r.update({"mode": mode, "size": size, "peak_rss_kb": peak})
+                    out["results"].append(r)
+                    print(f"[{mode} size={size}] {r['endpoint']:<13} {r['throughput_rps'] or 0:>10.1f} rps  "
+                          f"p50 {r['p50_ms']} ms  p99 {r['p99_ms']} ms  5xx {r['server_errors']}  "
+                          f"not {r['expected_status']}: {r['unexpected_status']}",
+                          file=sys.stderr)
+    with open(args.out, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"wrote {args.out}", file=sys.stderr)
+
+
+def cmd_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    def key(r):
+        return r["mode"], r["size"], r["endpoint"]
+
+    def delta(a, b):
+        return (b - a) / a * 100.0 if a and b is not None else None
+
+    def fmt(v):
+        return f"{v:+.1f}%" if v is not None else "n/a"
+
+    base = {key(r): r for r in old["results"]}
+    regressions = 0
+    print(f"{'mode':<9}{'size':>9} {'endpoint':<13}{'rps old':>11}{'rps new':>11}{'Δrps':>8}"
+          f"{'p99 old':>10}{'p99 new':>10}{'Δp99':>8}")
+    for r in new["results"]:
+        o = base.get(key(r))
+        if o is None:
+            continue
+        d_rps = delta(o["throughput_rps"], r["throughput_rps"])
+        d_p99 = delta(o["p99_ms"], r["p99_ms"])
+        worse = (d_rps is not None and d_rps < -args.threshold) or (d_p99 is not None and d_p99 > args.threshold)
+        # timings of responses that were not the expected status say nothing about the endpoint
+        wrong = r.get("unexpected_status", 0)
+        regressions += worse or bool(wrong)
+        if wrong:
+            flag = f"  <-- {wrong} unexpected status(es) {r.get('statuses')}"
+        else:
+            flag = "  <-- regression" if worse else ""
+        print(f"{r['mode']:<9}{r['size']:>9} {r['endpoint']:<13}{o['throughput_rps'] or 0:>11.1f}"
+              f"{r['throughput_rps'] or 0:>11.1f}{fmt(d_rps):>8}{o['p99_ms'] or 0:>10.2f}{r['p99_ms'] or 0:>10.2f}"
+              f"{fmt(d_p99):>8}{flag}")
+    print(f"commits: {old['meta'].get('commit')} -> {new['meta'].get('commit')}; "
+          f"{regressions} regression(s) beyond {args.threshold}%")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # internal child modes
+    if argv and argv[0] == "_seed":
+        return _child_seed(argv[1], int(argv[2]))
+    if argv and argv[0] == "_flask":
+        p = argparse.ArgumentParser()
+        p.add_argument("workdir")
+        p.add_argument("seed_file")
+        p.add_argument("--requests", type=int)
+        p.add_argument("--heavy-requests", type=int)
+        p.add_argument("--concurrency", type=int)
+        a = p.parse_args(argv[1:])
+        return _child_flask(a.workdir, a.seed_file, a)
+
+    parser = argparse.ArgumentParser(description="Benchmark the key-verification server.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    run = sub.add_parser("run", help="seed DBs and run the load scenarios")
+    run.add_argument("--sizes", default="1000,10000,100000", help="comma-separated key counts (up to 1000000)")
+    run.add_argument("--modes", default="flask,gunicorn", help="flask (test client), gunicorn and/or async (HTTP)")
+    run.add_argument("--requests", type=int, default=2000, help="requests per hot-path scenario")
+    run.add_argument("--heavy-requests", type=int, default=5, help="requests for download/upload scenarios")
+    run.add_argument("--concurrency", type=int, default=8, help="client threads")
+    run.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    run.add_argument("--threads", type=int, default=8, help="asyncserver.py db threads")
+    run.add_argument("--out", default="bench_results.json")
+    cmp_ = sub.add_parser("compare", help="compare two result files")
+    cmp_.add_argument("old")
+    cmp_.add_argument("new")
+    cmp_.add_argument("--threshold", type=float, default=10.0, help="percent change counted as a regression")
+    cmp_.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+    if args.cmd == "run":
+        return cmd_run(args)
+    return cmd_compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main() or 0)
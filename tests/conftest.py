@@ -0,0 +1,26 @@
+import os
+import sys
+import atexit
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def keyserver(tmp_path_factory):
+    """app.py, imported once in a scratch working directory."""
+    # app.py keeps keys.db / keys_db.json / server.log in the working directory.
+    # pytest restores the cwd at the end of the session, before app.py's atexit
+    # snapshot flush, so go back first (atexit runs the handler registered last first)
+    workdir = str(tmp_path_factory.mktemp("keyserver"))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import app
+    atexit.register(os.chdir, workdir)
+    return app
+
+
+@pytest.fixture
+def client(keyserver):
+    return keyserver.app.test_client()
@@ -0,0 +1,181 @@
+"""HTTP/1.1 framing of asyncserver.py: body lengths, chunked bodies, keep-alive."""
+import io
+import json
+import time
+import asyncio
+import http.client
+
+import pytest
+
+KEYS = "/keys?key=nope&device_id=x"
+
+
+@pytest.fixture(scope="module")
+def mod(keyserver):
+    import asyncserver
+    return asyncserver
+
+
+def exchange(mod, raw):
+    """Send raw bytes on one connection; returns everything received until the server closed it."""
+    async def go():
+        server = mod.Server(threads=2)
+        listener = await server.start("127.0.0.1", 0)
+        try:
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(raw)
+            await writer.drain()
+            data = await asyncio.wait_for(reader.read(), 30)
+            writer.close()
+            return data
+        finally:
+            await server.shutdown(listener)
+    return asyncio.run(go())
+
+
+class _Replay(io.BytesIO):
+    """Received bytes as a socket for http.client; responses share it and must not close it."""
+
+    def makefile(self, mode):
+        return self
+
+    def close(self):
+        pass
+
+
+def responses(data):
+    """Every response in data, parsed back to back the way a client frames them (bodies read)."""
+    sock = _Replay(data)
+    out = []
+    while sock.tell() < len(data):
+        resp = http.client.HTTPResponse(sock)
+        resp.begin()
+        resp.body = resp.read()
+        out.append(resp)
+    return out
+
+
+def statuses(data):
+    return [resp.status for resp in responses(data)]
+
+
+def get(path, close=False, version="HTTP/1.1", headers=()):
+    head = "".join(f"{k}: {v}\r\n" for k, v in headers) + ("Connection: close\r\n" if close else "")
+    return f"GET {path} {version}\r\nHost: t\r\n{head}\r\n".encode()
+
+
+def test_keep_alive_serves_several_requests(mod):
+    assert statuses(exchange(mod, get(KEYS) + get(KEYS) + get(KEYS, close=True))) == [401, 401, 401]
+
+
+def test_not_modified_has_no_body_on_keep_alive(mod):
+    auth = [("X-PASS", mod.keyserver.PASS_DOWNLOAD)]
+    etag = responses(exchange(mod, get("/download_db", close=True, headers=auth)))[0].getheader("ETag")
+    data = exchange(mod, get("/download_db", headers=auth + [("If-None-Match", etag)]) + get(KEYS, close=True))
+    first, second = responses(data)
+    assert (first.status, first.body, second.status) == (304, b"", 401)
+    assert first.getheader("Transfer-Encoding") is None
+    assert data.count(b"HTTP/1.1 ") == 2 and b"\r\n0\r\n" not in data
+
+
+def test_http10_closes_after_one_request(mod):
+    data = exchange(mod, get(KEYS, version="HTTP/1.0") + get(KEYS, version="HTTP/1.0"))
+    assert statuses(data) == [401]
+    assert b"Connection: close" in data
+
+
+def test_content_length_body_then_next_request(mod):
+    req = b"POST /ids?key=nope HTTP/1.1\r\nHost: t\r\nContent-Length: 4\r\n\r\ndevX"
+    assert statuses(exchange(mod, req + get(KEYS, close=True))) == [401, 401]
+
+
+def test_chunked_body(mod):
+    req = (b"POST /ids?key=d-0924-3841 HTTP/1.1\r\nHost: t\r\nTransfer-Encoding: chunked\r\n\r\n"
+           b"2\r\nch\r\n3;ext=1\r\nunk\r\n9\r\ned-device\r\n0\r\nX-Trailer: 1\r\n\r\n")
+    # the key is now bound to the device named by the reassembled body
+    assert statuses(exchange(mod, req + get("/keys?key=d-0924-3841&device_id=chunked-device", close=True))) == [200, 200]
+
+
+@pytest.mark.parametrize("value", ["+4", "4_0", "0x4", "-4", "4,4", "", "4 4"])
+def test_rejects_non_digit_content_length(mod, value):
+    req = f"POST /ids?key=nope HTTP/1.1\r\nHost: t\r\nContent-Length: {value}\r\n\r\ndevX".encode()
+    assert statuses(exchange(mod, req + get(KEYS))) == [400]
+
+
+def test_rejects_repeated_content_length(mod):
+    req = b"POST /ids?key=nope HTTP/1.1\r\nHost: t\r\nContent-Length: 4\r\nContent-Length: 5\r\n\r\ndevX"
+    assert statuses(exchange(mod, req + get(KEYS))) == [400]
+
+
+def test_rejects_transfer_encoding_with_content_length(mod):
+    req = (b"POST /ids?key=nope HTTP/1.1\r\nHost: t\r\nTransfer-Encoding: chunked\r\nContent-Length: 4\r\n\r\n"
+           b"4\r\ndevX\r\n0\r\n\r\n")
+    assert statuses(exchange(mod, req + get(KEYS))) == [400]
+
+
+@pytest.mark.parametrize("size", [b"+4", b"0x4", b"4_0", b" 4", b"4 ", b"-4", b""])
+def test_rejects_malformed_chunk_size(mod, size):
+    req = (b"POST /ids?key=nope HTTP/1.1\r\nHost: t\r\nTransfer-Encoding: chunked\r\n\r\n"
+           + size + b"\r\ndevX\r\n0\r\n\r\n")
+    assert statuses(exchange(mod, req + get(KEYS))) == [400]
+
+
+def test_rejects_chunk_without_crlf(mod):
+    req = (b"POST /ids?key=nope HTTP/1.1\r\nHost: t\r\nTransfer-Encoding: chunked\r\n\r\n"
+           b"2\r\ndevX\r\n0\r\n\r\n")
+    assert statuses(exchange(mod, req + get(KEYS))) == [400]
+
+
+def test_admin_write_only_sends_its_transaction_to_the_writer(mod, monkeypatch):
+    threads = []
+    rewrite = mod.keyserver.update_snapshot_from_sqlite
+
+    def recording_rewrite():
+        threads.append(mod.threading.current_thread().name)
+        return rewrite()
+
+    monkeypatch.setattr(mod.keyserver, "update_snapshot_from_sqlite", recording_rewrite)
+    body = b'{"key": "async-admin-key"}'
+    req = (b"POST /add_key HTTP/1.1\r\nHost: t\r\nX-PASS: " + mod.keyserver.PASS_ADD.encode()
+           + b"\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+    data = exchange(mod, req + get("/keys?key=async-admin-key&device_id=d1", close=True))
+    assert statuses(data) == [200, 200]
+    assert threads and "db-writer" not in threads
+
+
+def test_background_writes_go_through_the_writer(mod, monkeypatch, tmp_path):
+    ks = mod.keyserver
+    committed_on, swapped_on = set(), []
+    commit, swap = ks.TimedConnection.commit, ks.swap_in_staging
+
+    def recording_commit(self):
+        committed_on.add(mod.threading.current_thread().name)
+        return commit(self)
+
+    def recording_swap(cons):
+        swapped_on.append(mod.threading.current_thread().name)
+        return swap(cons)
+
+    upload = tmp_path / "upload.json"
+    upload.write_text(json.dumps(ks.DEFAULT_DB))
+
+    async def go():
+        server = mod.Server(threads=2)
+        listener = await server.start("127.0.0.1", 0)
+        try:
+            monkeypatch.setattr(ks.TimedConnection, "commit", recording_commit)
+            ks.buffer_heartbeat(None, "d-0924-3841", "hb-device", time.time())
+            ks.flush_heartbeats()
+            ks.record_snapshot(ks.total_change_counter(ks.all_dbs()))
+            ks._claim_sweep_round()
+            monkeypatch.undo()
+            # (staging itself commits here: it only writes the scratch file)
+            monkeypatch.setattr(ks, "swap_in_staging", recording_swap)
+            ks.restore_from_json_upload(str(upload))
+        finally:
+            await server.shutdown(listener)
+
+    asyncio.run(go())
+    assert committed_on == {"db-writer"}
+    assert swapped_on == ["db-writer"]
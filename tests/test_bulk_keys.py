@@ -0,0 +1,23 @@
+"""/add_keys and /delete_keys with the compact diff response."""
+import pytest
+
+
+def _post(client, keyserver, route, keys):
+    password = keyserver.PASS_ADD if route == "/add_keys" else keyserver.PASS_DELETE
+    return client.post(f"{route}?response=diff", json={"keys": keys}, headers={"X-PASS": password})
+
+
+def test_diff_reports_added_and_already_present(client, keyserver):
+    r = _post(client, keyserver, "/add_keys", ["bulk-a", "bulk-b", "bulk-a"])
+    assert r.get_json()["counts"] == {"added": 2, "already_present": 0}
+    r = _post(client, keyserver, "/add_keys", ["bulk-a", "bulk-c"])
+    assert (r.get_json()["added"], r.get_json()["already_present"]) == (["bulk-c"], ["bulk-a"])
+    r = _post(client, keyserver, "/delete_keys", ["bulk-a", "bulk-missing"])
+    assert (r.get_json()["deleted"], r.get_json()["not_found"]) == (["bulk-a"], ["bulk-missing"])
+
+
+@pytest.mark.parametrize("route", ["/add_keys", "/delete_keys"])
+@pytest.mark.parametrize("bad", [1, "", None, ["x"], {"k": 1}])
+def test_non_string_keys_are_rejected(client, keyserver, route, bad):
+    r = _post(client, keyserver, route, ["bulk-ok", bad])
+    assert r.status_code == 400
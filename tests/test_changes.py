@@ -0,0 +1,38 @@
+"""Change log (/changes) and its compaction."""
+
+
+def _add(client, keyserver, *keys):
+    r = client.post("/add_keys?response=diff", json={"keys": list(keys)}, headers={"X-PASS": keyserver.PASS_ADD})
+    assert r.status_code == 200
+
+
+def _poll(client, keyserver, since):
+    return client.get(f"/changes?since={since}", headers={"X-PASS": keyserver.PASS_DOWNLOAD})
+
+
+def test_compact_past_the_end_keeps_later_changes(client, keyserver):
+    _add(client, keyserver, "changes-before")
+    last = keyserver.get_last_change_seq(keyserver.get_db(0))
+    r = client.post("/changes/compact", json={"before_seq": last + 1000}, headers={"X-PASS": keyserver.PASS_DELETE})
+    assert r.status_code == 200
+    assert r.get_json()["min_seq"] == last
+
+    _add(client, keyserver, "changes-after")
+    r = _poll(client, keyserver, r.get_json()["min_seq"])
+    assert r.status_code == 200
+    assert [c["key"] for c in r.get_json()["changes"]] == ["changes-after"]
+    assert _poll(client, keyserver, 0).status_code == 410
+
+
+def test_compact_rejects_non_object_body(client, keyserver):
+    r = client.post("/changes/compact", json=[1], headers={"X-PASS": keyserver.PASS_DELETE})
+    assert r.status_code == 400
+
+
+def test_limit_is_clamped_to_one(client, keyserver):
+    _add(client, keyserver, "changes-limit-a", "changes-limit-b")
+    since = keyserver.get_last_change_seq(keyserver.get_db(0)) - 2
+    for limit in (0, -5):
+        r = client.get(f"/changes?since={since}&limit={limit}", headers={"X-PASS": keyserver.PASS_DOWNLOAD})
+        body = r.get_json()
+        assert (r.status_code, len(body["changes"]), body["has_more"]) == (200, 1, True)
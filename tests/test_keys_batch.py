@@ -0,0 +1,17 @@
+"""/keys_batch: many verifications in one request and one transaction."""
+
+
+def test_bad_items_get_their_own_400(client, keyserver):
+    r = client.post("/add_keys?response=diff", json={"keys": ["batch-ok"]}, headers={"X-PASS": keyserver.PASS_ADD})
+    assert r.status_code == 200
+    items = [
+        {"key": "batch-ok", "device_id": "batch-dev"},
+        {"key": "batch-ok", "device_id": "batch-dev", "sig": ["x"], "package": "com.sahil.work"},
+        {"key": "batch-ok", "device_id": "batch-dev", "sig": "x", "package": {"a": 1}},
+        {"key": "batch-ok", "device_id": "batch-dev", "sig": None, "package": 5},
+        {"key": 5, "device_id": "batch-dev"},
+        7,
+    ]
+    r = client.post("/keys_batch", json={"items": items})
+    assert r.status_code == 200
+    assert [x["status"] for x in r.get_json()["results"]] == [200, 400, 400, 400, 400, 400]
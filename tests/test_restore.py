@@ -0,0 +1,55 @@
+"""/upload_db: a keys_db.json upload staged aside and swapped in atomically."""
+import io
+import json
+import sqlite3
+import threading
+
+import pytest
+
+
+def _upload(client, keyserver, raw):
+    return client.post("/upload_db", data={"file": (io.BytesIO(raw), "keys_db.json")},
+                       headers={"X-PASS": keyserver.PASS_UPLOAD})
+
+
+def _simple(keys, **entry):
+    return json.dumps({"SECURE_KEYS": {}, "SIMPLE_KEYS": {
+        k: dict({"is_used": False, "device_id": None, "last_verified": None}, **entry) for k in keys}}).encode()
+
+
+@pytest.mark.parametrize("raw", [
+    b"{not json",
+    b'{"SIMPLE_KEYS": {"k": 1}}',
+    _simple(["k"], device_id=[1]),
+    _simple(["k"], device_id={"a": 1}),
+    _simple(["k"], last_verified="yesterday"),
+    _simple(["k"], last_verified=True),
+    _simple(["k"], is_used="x"),
+])
+def test_malformed_upload_is_rejected_and_changes_nothing(client, keyserver, raw):
+    assert _upload(client, keyserver, _simple(["restore-live"])).status_code == 200
+    r = _upload(client, keyserver, raw)
+    assert r.status_code == 400
+    assert list(keyserver.sqlite_to_json()["SIMPLE_KEYS"]) == ["restore-live"]
+
+
+def test_readers_never_see_an_empty_table(client, keyserver):
+    assert _upload(client, keyserver, _simple(["restore-%d" % i for i in range(20000)])).status_code == 200
+    counts, done = [], threading.Event()
+
+    def read():
+        con = sqlite3.connect(keyserver.shard_file(0))
+        while not done.is_set():
+            counts.append(con.execute("SELECT COUNT(*) FROM simple_keys").fetchone()[0])
+        con.close()
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        for n in (15000, 20000, 15000):
+            assert _upload(client, keyserver, _simple(["restore-%d" % i for i in range(n)])).status_code == 200
+    finally:
+        done.set()
+        reader.join()
+    assert counts and min(counts) >= 15000
+    assert set(counts) <= {15000, 20000}
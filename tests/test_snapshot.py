@@ -0,0 +1,27 @@
+"""keys_db.json, the JSON snapshot kept next to the sqlite store."""
+import io
+import os
+import json
+import stat
+
+
+def _mode(keyserver):
+    return stat.S_IMODE(os.stat(keyserver.DB_JSON_FILE).st_mode)
+
+
+def test_rewrite_keeps_the_snapshot_mode(keyserver):
+    os.chmod(keyserver.DB_JSON_FILE, 0o640)
+    assert keyserver.write_json_snapshot_from_sqlite()
+    assert _mode(keyserver) == 0o640
+
+    os.remove(keyserver.DB_JSON_FILE)
+    assert keyserver.write_json_snapshot_from_sqlite()
+    assert _mode(keyserver) == 0o666 & ~keyserver._UMASK
+
+
+def test_upload_keeps_the_snapshot_mode(client, keyserver):
+    os.chmod(keyserver.DB_JSON_FILE, 0o644)
+    upload = io.BytesIO(json.dumps(keyserver.DEFAULT_DB).encode())
+    r = client.post("/upload_db", data={"file": (upload, "keys_db.json")}, headers={"X-PASS": keyserver.PASS_UPLOAD})
+    assert r.status_code == 200
+    assert _mode(keyserver) == 0o644
@@ -0,0 +1,21 @@
+"""Releasing bindings that were not verified for a while."""
+import time
+
+
+def test_sweep_releases_only_idle_bindings(client, keyserver):
+    r = client.post("/add_keys?response=diff", json={"keys": ["sweep-old", "sweep-new"]},
+                    headers={"X-PASS": keyserver.PASS_ADD})
+    assert r.status_code == 200
+    assert client.get("/keys?key=sweep-old&device_id=d1").status_code == 200
+    time.sleep(0.3)
+    assert client.get("/keys?key=sweep-new&device_id=d2").status_code == 200
+    r = client.post("/sweep_stale", json={"older_than": 0.2}, headers={"X-PASS": keyserver.PASS_DELETE})
+    assert r.status_code == 200 and r.get_json()["released"] >= 1
+    assert client.get("/keys?key=sweep-old&device_id=other").status_code == 200
+    assert client.get("/keys?key=sweep-new&device_id=other").status_code == 403
+
+
+def test_sweep_rejects_non_object_body(client, keyserver):
+    for body in ([1], "x", 5):
+        r = client.post("/sweep_stale", json=body, headers={"X-PASS": keyserver.PASS_DELETE})
+        assert r.status_code == 400
@@ -0,0 +1,28 @@
+"""Verification-token revocations shared between workers through REVOCATION_FILE."""
+import time
+import fcntl
+import threading
+
+
+def test_revocation_queued_behind_compaction_is_kept(keyserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(keyserver, "VERIFY_TOKEN_TTL_SECONDS", 60)
+    path = str(tmp_path / "revoked")
+    first, second = keyserver.TokenRevocations(path), keyserver.TokenRevocations(path)
+    first.revoke(None, ["kept-1"])
+
+    # "second" waits for the lock while "first" compacts (and so replaces) the file
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        waiting = threading.Thread(target=second.revoke, args=(None, ["kept-2"]))
+        waiting.start()
+        time.sleep(0.2)
+        assert waiting.is_alive()
+        first._compact()
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    waiting.join()
+
+    reader = keyserver.TokenRevocations(path)
+    issued = time.time() - 1
+    assert reader.is_revoked(None, "kept-1", issued)
+    assert reader.is_revoked(None, "kept-2", issued)
+    assert not reader.is_revoked(None, "never-revoked", issued)